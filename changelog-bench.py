@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+#
+# Benchmarks for the changelog library and CLI, with a generator for
+# synthetic .changes and debian.changelog files.
+#
+# (c) Kurt Garloff <kurt@garloff.de>, 1/2018
+# License: CC-BY-SA 3.0
+
+import sys
+import os
+import time
+import json
+import random
+import datetime
+import subprocess
+import tracemalloc
+import pytz
+import changelog
+from six import print_
+
+# Generator parameters
+nentries = 2000
+maxitems = 4
+maxsubs  = 3
+wrapped  = 0.3
+cvefrac  = 0.1
+nauthors = 20
+zones    = ['UTC', 'Europe/Berlin', 'America/New_York', 'Asia/Shanghai', 'Europe/London', 'America/Los_Angeles', 'Asia/Tokyo']
+seed     = 42
+pkgnm    = 'foo'
+# Benchmark parameters
+repeat   = 3
+outnm    = None
+basenm   = None
+tolerance= 0.1
+
+WORDS = ('fix', 'update', 'add', 'remove', 'build', 'crash', 'memory', 'parser',
+	 'option', 'handle', 'long-standing', 'issue', 'with', 'x86-64', 'support',
+	 'in', 'config', 'file', 'path', 'api', 'deprecated', 'the', 'a', 'for',
+	 'when', 'error', 'message', 'test', 'suite', 'documentation', 'typo',
+	 'aarch64', 'compiler', 'warning', 'upstream', 'patch', 'dependency')
+
+def helpout(rc=1):
+	print_("Usage: changelog-bench.py [options] gen out.changes [out.changelog]", file=sys.stderr)
+	print_("       changelog-bench.py [options] run", file=sys.stderr)
+	print_(" Generator options:", file=sys.stderr)
+	print_(" -n, --entries N: Number of entries (def=2000)", file=sys.stderr)
+	print_(" -i, --items N: Max items per entry (def=4)", file=sys.stderr)
+	print_(" -s, --subitems N: Max subitems per item (def=3)", file=sys.stderr)
+	print_(" -w, --wrapped F: Fraction of pre-wrapped (multi-line) items (def=0.3)", file=sys.stderr)
+	print_(" -c, --cve F: Fraction of items mentioning a CVE (def=0.1)", file=sys.stderr)
+	print_(" -a, --authors N: Number of different authors (def=20)", file=sys.stderr)
+	print_(" -z, --zones LIST: Comma separated timezones to use", file=sys.stderr)
+	print_(" -S, --seed N: Random seed (def=42)", file=sys.stderr)
+	print_(" Benchmark options:", file=sys.stderr)
+	print_(" -r, --repeat N: Repetitions per benchmark, best is taken (def=3)", file=sys.stderr)
+	print_(" -o, --output FILE: Write results as JSON to FILE", file=sys.stderr)
+	print_(" -b, --baseline FILE: Compare against results stored in FILE", file=sys.stderr)
+	print_(" -t, --tolerance F: Slowdown vs. baseline to flag (def=0.1)", file=sys.stderr)
+	sys.exit(rc)
+
+def parse_args(argv):
+	"Parse command line args"
+	import getopt
+	global nentries, maxitems, maxsubs, wrapped, cvefrac, nauthors, zones, seed
+	global repeat, outnm, basenm, tolerance
+	try:
+		optlist, args = getopt.gnu_getopt(argv, 'hn:i:s:w:c:a:z:S:r:o:b:t:', ('help', 'entries=', 'items=', 'subitems=', 'wrapped=', 'cve=', 'authors=', 'zones=', 'seed=', 'repeat=', 'output=', 'baseline=', 'tolerance='))
+	except getopt.GetoptError as exc:
+		print_(exc)
+		helpout(1)
+	for (opt, arg) in optlist:
+		if opt == '-h' or opt == '--help':
+			helpout(0)
+		if opt == '-n' or opt == '--entries':
+			nentries = int(arg)
+		elif opt == '-i' or opt == '--items':
+			maxitems = int(arg)
+		elif opt == '-s' or opt == '--subitems':
+			maxsubs = int(arg)
+		elif opt == '-w' or opt == '--wrapped':
+			wrapped = float(arg)
+		elif opt == '-c' or opt == '--cve':
+			cvefrac = float(arg)
+		elif opt == '-a' or opt == '--authors':
+			nauthors = int(arg)
+		elif opt == '-z' or opt == '--zones':
+			zones = arg.split(',')
+		elif opt == '-S' or opt == '--seed':
+			seed = int(arg)
+		elif opt == '-r' or opt == '--repeat':
+			repeat = int(arg)
+		elif opt == '-o' or opt == '--output':
+			outnm = arg
+		elif opt == '-b' or opt == '--baseline':
+			basenm = arg
+		elif opt == '-t' or opt == '--tolerance':
+			tolerance = float(arg)
+	if len(args) < 2 or args[1] not in ('gen', 'run'):
+		helpout(1)
+	return args[1:]
+
+def gentext(rnd, indent, nwords):
+	"Random text, either one long line or pre-wrapped"
+	words = [rnd.choice(WORDS) for i in range(nwords)]
+	if rnd.random() < cvefrac:
+		words.insert(rnd.randint(0, nwords), 'CVE-%i-%i' % (rnd.randint(2000, 2025), rnd.randint(1000, 49999)))
+	txt = ' '.join(words)
+	if rnd.random() >= wrapped:
+		return txt
+	return changelog.dowrap(txt, indent, 68)
+
+def genauthors(rnd):
+	"List of (email, timezone) for nauthors authors"
+	authors = []
+	for idx in range(nauthors):
+		tz = zones[idx % len(zones)]
+		dom = 'example.cn' if tz == 'Asia/Shanghai' else rnd.choice(('example.org', 'suse.com', 'garloff.de'))
+		authors.append(('%s.%s@%s' % (rnd.choice(('kurt', 'anna', 'li', 'john', 'maria')), 'dev%i' % idx, dom), pytz.timezone(tz)))
+	return authors
+
+def genrpm():
+	"Generate synthetic RPM .changes text (newest first)"
+	rnd = random.Random(seed)
+	authors = genauthors(rnd)
+	date = datetime.datetime(2025, 6, 1, 12, 0, 0)
+	ver = [nentries//100 + 1, 0, 0]
+	out = []
+	for ent in range(nentries):
+		# Strictly older than the previous entry (in UTC, so the
+		# authors' time zones can't reorder them)
+		prev = date
+		date -= datetime.timedelta(seconds = rnd.randint(3600, 86400*3))
+		date = date.replace(hour = rnd.randint(8, 20))
+		if date >= prev:
+			date -= datetime.timedelta(days = 1)
+		(email, tzi) = rnd.choice(authors)
+		out.append('%s\n%s - %s\n\n' % (changelog.RPMSEP, changelog.fmtrpmdate(pytz.utc.localize(date).astimezone(tzi)), email))
+		for itm in range(rnd.randint(1, maxitems)):
+			if itm == 0 and rnd.random() < 0.5:
+				out.append('- Update to %s-%i.%i.%i:\n' % (pkgnm, ver[0], ver[1], ver[2]))
+				ver[2] -= 1
+				if ver[2] < 0:
+					ver[2] = 9
+					ver[1] -= 1
+				if ver[1] < 0:
+					ver[1] = 9
+					ver[0] -= 1
+			else:
+				out.append('- %s\n' % gentext(rnd, 2, rnd.randint(3, 40)))
+			for sub in range(rnd.randint(0, maxsubs)):
+				out.append('  * %s\n' % gentext(rnd, 4, rnd.randint(2, 30)))
+		out.append('\n')
+	return ''.join(out)
+
+def gendeb(rpmtxt):
+	"Generate debian.changelog text from RPM text"
+	import io
+	chglog = changelog.changelog(pkgnm = pkgnm)
+	chglog.rpmparse(io.StringIO(rpmtxt), True)
+	return chglog.debout()
+
+def clearcaches():
+	"Reset memoization, so every repetition starts cold"
+	changelog.wrapcache.clear()
+	changelog.datecache.clear()
+	changelog.tzidx.nmcache.clear()
+	changelog.tzidx.offcache.clear()
+
+def measure(func, nent):
+	"Time func (best of repeat runs), then once more for peak memory"
+	best = None
+	for rep in range(repeat):
+		clearcaches()
+		start = time.time()
+		func()
+		secs = time.time() - start
+		if best is None or secs < best:
+			best = secs
+	clearcaches()
+	tracemalloc.start()
+	func()
+	peak = tracemalloc.get_traced_memory()[1]
+	tracemalloc.stop()
+	return {'secs': best, 'entries_per_s': nent/best if best else None, 'peak_bytes': peak}
+
+# Forks the CLI from a fresh interpreter: Linux carries the high water
+# RSS of a process over fork and exec, so rusage of a child forked from
+# the (large) benchmark process would report our own peak instead
+CLIWRAP = """
+import os, sys, time
+start = time.time()
+pid = os.fork()
+if not pid:
+	os.execv(sys.executable, [sys.executable] + sys.argv[1:])
+(pid, status, usage) = os.wait4(pid, 0)
+print("%d %f %d" % (status, time.time() - start, usage.ru_maxrss))
+"""
+
+def measurecli(args, nent):
+	"Time CLI run in a subprocess (best of repeat runs) and its peak RSS"
+	cli = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'changelog-transform.py')
+	best = None
+	peak = 0
+	for rep in range(repeat):
+		out = subprocess.check_output([sys.executable, '-c', CLIWRAP, cli] + args)
+		(status, secs, maxrss) = out.split()[-3:]
+		if int(status):
+			raise subprocess.CalledProcessError(int(status), cli)
+		secs = float(secs)
+		if best is None or secs < best:
+			best = secs
+		# ru_maxrss is in kB on Linux
+		peak = max(peak, int(maxrss) * 1024)
+	return {'secs': best, 'entries_per_s': nent/best, 'peak_rss_bytes': peak}
+
+def runbench():
+	"Run all benchmarks, return results dict"
+	import io
+	import tempfile
+	rpmtxt = genrpm()
+	debtxt = gendeb(rpmtxt)
+	res = {}
+	def rpmparse():
+		return changelog.changelog(pkgnm = pkgnm).rpmparse(io.StringIO(rpmtxt))
+	def debparse():
+		return changelog.changelog().debparse(io.StringIO(debtxt))
+	res['rpmparse'] = measure(rpmparse, nentries)
+	res['debparse'] = measure(debparse, nentries)
+	rpmlog = rpmparse()
+	deblog = debparse()
+	res['rpmout'] = measure(deblog.rpmout, nentries)
+	res['debout'] = measure(rpmlog.debout, nentries)
+	texts = [(txt, ind, lnln) for ent in rpmlog.entries for itm in ent.items
+			for (txt, ind, lnln) in [(itm.head, 2, 68)] + [(sub, 4, 70) for sub in itm.subitems]]
+	def wrap():
+		for (txt, ind, lnln) in texts:
+			changelog.wrap(txt, ind, lnln)
+	res['wrap'] = measure(wrap, nentries)
+	tzs = [(changelog.fmtrpmdate(ent.date).split(' ')[-2], ent.date.replace(tzinfo=None), ent.email) for ent in rpmlog.entries]
+	offs = [(changelog.fmtdebdate(ent.date)[-5:], ent.date, ent.email) for ent in deblog.entries]
+	def findtz():
+		for (tznm, date, email) in tzs:
+			changelog.findtz(tznm, date, email)
+	def findtzoff():
+		for (offstr, date, email) in offs:
+			changelog.findtzoff(offstr, date, email)
+	changelog.tzidx.ensure()
+	res['findtz'] = measure(findtz, nentries)
+	res['findtzoff'] = measure(findtzoff, nentries)
+	tmpdir = tempfile.mkdtemp(prefix='chlog-bench-')
+	rpmnm = os.path.join(tmpdir, pkgnm + '.changes')
+	debnm = os.path.join(tmpdir, 'debian.changelog')
+	open(rpmnm, 'w').write(rpmtxt)
+	open(debnm, 'w').write(debtxt)
+	res['cli_rpm2deb'] = measurecli([rpmnm, os.path.join(tmpdir, 'out.changelog')], nentries)
+	res['cli_deb2rpm'] = measurecli([debnm, os.path.join(tmpdir, 'out.changes')], nentries)
+	for nm in (rpmnm, debnm, os.path.join(tmpdir, 'out.changelog'), os.path.join(tmpdir, 'out.changes')):
+		os.unlink(nm)
+	os.rmdir(tmpdir)
+	return res
+
+def compare(res, base):
+	"Print comparison to baseline, return number of regressions"
+	nreg = 0
+	for (nm, val) in sorted(res.items()):
+		if nm not in base:
+			print_("%-12s %8.4fs  (no baseline)" % (nm, val['secs']))
+			continue
+		ratio = val['secs']/base[nm]['secs']
+		flag = ''
+		if ratio > 1 + tolerance:
+			flag = '  REGRESSION'
+			nreg += 1
+		print_("%-12s %8.4fs  baseline %8.4fs  x%.2f%s" % (nm, val['secs'], base[nm]['secs'], ratio, flag))
+	return nreg
+
+def main(argv):
+	args = parse_args(argv)
+	if args[0] == 'gen':
+		if len(args) < 2:
+			helpout(1)
+		rpmtxt = genrpm()
+		open(args[1], 'w').write(rpmtxt)
+		if len(args) > 2:
+			open(args[2], 'w').write(gendeb(rpmtxt))
+		return 0
+
+	res = runbench()
+	params = {'entries': nentries, 'items': maxitems, 'subitems': maxsubs,
+		  'wrapped': wrapped, 'cve': cvefrac, 'authors': nauthors,
+		  'zones': zones, 'seed': seed, 'repeat': repeat}
+	out = {'params': params, 'python': sys.version.split()[0],
+	       'date': datetime.datetime.now().isoformat(), 'results': res}
+	if outnm:
+		json.dump(out, open(outnm, 'w'), indent=1, sort_keys=True)
+	if basenm:
+		base = json.load(open(basenm, 'r'))
+		if base.get('params') != params:
+			print_("WARN: Baseline was run with different parameters", file=sys.stderr)
+		return 1 if compare(res, base['results']) else 0
+	for (nm, val) in sorted(res.items()):
+		print_("%-12s %8.4fs %10.0f entries/s" % (nm, val['secs'], val['entries_per_s']))
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv))
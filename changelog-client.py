@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+#
+# Thin client for changelog-transform.py -D (daemon mode): Passes the
+# command line (and stdin if the input is -) to the daemon and outputs
+# its answer. Converts in-process if no daemon is listening.
+# Usage is the same as for changelog-transform.py.
+#
+# (c) Kurt Garloff <kurt@garloff.de>, 1/2018
+# License: CC-BY-SA 3.0
+
+import sys
+import os
+import json
+import socket
+
+def socketname():
+	"Socket the daemon listens on (see changelog-transform.py --socket)"
+	return os.environ.get('CHANGELOG_TRANSFORM_SOCKET', os.environ['HOME']+'/.changelog-transform/daemon.sock')
+
+# Options of changelog-transform.py parse_args(), keep them in sync
+SHORTOPTS = 'vqhi:o:trV:a:d:n:m:eEz:csbj:upMCK:SJ:P:DIQWk'
+LONGOPTS = ('help', 'quiet', 'verbose', 'tolerant', 'rewrap', 'infmt=', 'outfmt=', 'version=', 'distro=', 'pkgname=', 'maxent=', 'since=', 'until-version=', 'emails=', 'emaildb', 'emaildbguess', 'tzcache=', 'cache', 'cachesize=', 'stream', 'batch', 'jobs=', 'update', 'parallel', 'merge', 'force', 'check', 'keywords=', 'stats', 'statsjson=', 'profile=', 'daemon', 'socket=', 'index', 'query', 'indexdb=', 'watch', 'journal=', 'quarantine=', 'combine')
+
+def readsstdin(argv):
+	"""Does the command line read from stdin (an input file -)?
+	   Options may come after the file names (gnu_getopt)."""
+	import getopt
+	try:
+		args = getopt.gnu_getopt(argv[1:], SHORTOPTS, LONGOPTS)[1]
+	except getopt.GetoptError:
+		# The daemon will complain
+		return False
+	return '-' in args[:-1]
+
+def request(argv):
+	"Send request to daemon, return answer dict or None if no daemon listens"
+	sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	try:
+		sock.connect(socketname())
+	except socket.error:
+		sock.close()
+		return None
+	req = {'argv': argv[1:], 'cwd': os.getcwd()}
+	if readsstdin(argv):
+		req['stdin'] = sys.stdin.read()
+	sock.sendall(json.dumps(req).encode('utf-8') + b'\n')
+	sock.shutdown(socket.SHUT_WR)
+	rfd = sock.makefile('rb')
+	ans = rfd.readline()
+	rfd.close()
+	sock.close()
+	if not ans:
+		raise IOError("No answer from daemon on %s" % socketname())
+	return json.loads(ans.decode('utf-8'))
+
+def fallback(argv):
+	"Run changelog-transform.py in this process"
+	import runpy
+	trans = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'changelog-transform.py')
+	sys.argv = [trans] + argv[1:]
+	runpy.run_path(trans, run_name = '__main__')
+
+def main(argv):
+	ans = request(argv)
+	if ans is None:
+		return fallback(argv)
+	sys.stdout.write(ans['stdout'])
+	sys.stderr.write(ans['stderr'])
+	return ans['rc']
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv))
@@ -7,6 +7,8 @@
 
 import sys
 import os
+import io
+import copy
 import changelog
 from six import print_
 
@@ -20,22 +22,104 @@ initver  = '?-0'
 dist     = 'stable'
 pkgnm    = ''
 maxent   = 0
+since    = None
+untilver = None
 emails   = {}
 emaildb  = False
 guessmail= False
+tzcache  = None
+stream   = False
+batchmode= False
+watchmode= False
+jobs     = 0
+incr     = False
+parallel = False
+mergemode= False
+force    = False
+combinemode = False
+entcache = False
+cachesize= 64
+check    = False
+keywords = None
+stats    = False
+statsjson= None
+profile  = None
+daemon   = False
+socknm   = os.environ.get('CHANGELOG_TRANSFORM_SOCKET', os.environ['HOME']+'/.changelog-transform/daemon.sock')
+journal  = None
+quarantine = None
+indexmode= False
+querymode= False
+indexdb  = os.environ['HOME']+'/.changelog-transform/index.sqlite'
+
+# Defaults of the option globals above, every daemon request starts from them
+OPTDEFAULTS = dict((nm, copy.copy(val)) for (nm, val) in globals().items()
+		   if nm[0] != '_' and not callable(val) and not isinstance(val, type(sys)))
+
+warmemails = None
+# (action, message) of the problems worked around by tolerant parsing
+problems = []
 
 def helpout(rc=1):
 	print_("Usage: changelog-transform.py [options] in out", file=sys.stderr)
+	print_("       (in/out may be .gz/.bz2/.xz compressed, in may also be", file=sys.stderr)
+	print_("        ARCHIVE[:MEMBER] for .tar[.*]/.cpio[.*]/.obscpio archives)", file=sys.stderr)
+	print_("       changelog-transform.py [options] -b DIR|MANIFEST", file=sys.stderr)
+	print_("       changelog-transform.py [options] -W in out|DIR", file=sys.stderr)
+	print_("       changelog-transform.py [options] -k in in [..] out", file=sys.stderr)
+	print_("       changelog-transform.py [options] -D", file=sys.stderr)
+	print_("       changelog-transform.py [options] -I DIR|FILE [DIR|FILE [..]]", file=sys.stderr)
+	print_("       changelog-transform.py [options] -Q [WORD|FIELD:VALUE [..]]", file=sys.stderr)
 	print_(" Options:", file=sys.stderr)
 	print_(" -h, --help: Output this help", file=sys.stderr)
 #	print_(" -v, --verbose: Increase verbosity (not implemented)", file=sys.stderr)
 #	print_(" -q, --quiet: Be quiet (not implemented)", file=sys.stderr)
 	print_(" -r, --rewrap: Rewrap changelog entries to fill width", file=sys.stderr)
-	print_(" -t, --tolerant: Tolerate non-std formatting", file=sys.stderr)
-	print_(" -i, --infmt rpm/deb: Override input file detection", file=sys.stderr)
-	print_(" -o, --outfmt rpm/deb: Override output file detection", file=sys.stderr)
+	print_(" -t, --tolerant: Tolerate non-std formatting: Salvage odd items/headers,", file=sys.stderr)
+	print_("    skip broken entries, warn (not with -M)", file=sys.stderr)
+	print_(" -i, --infmt rpm/deb/json/ndjson: Override input file detection", file=sys.stderr)
+	print_(" -o, --outfmt rpm/deb/json/ndjson: Override output file detection", file=sys.stderr)
+	print_("    (.json: array of entries, .ndjson/.jsonl: one entry per line, streamed)", file=sys.stderr)
 	print_(" -m, --maxent no: Set max number of entries to process (def=all)", file=sys.stderr)
+	print_(" --since DATE: Only process entries from DATE (YYYY-MM-DD[THH:MM[:SS]] local", file=sys.stderr)
+	print_("    time) on, stop reading at the first older one", file=sys.stderr)
+	print_(" --until-version VER: Only process entries down to the one that introduced", file=sys.stderr)
+	print_("    VER[-rel], stop reading after it", file=sys.stderr)
+	print_(" -b, --batch: Convert all .changes/debian.changelog pairs below DIR", file=sys.stderr)
+	print_("    or the \"in out\" pairs listed in MANIFEST", file=sys.stderr)
+	print_(" --journal FILE: Record finished -b conversions in FILE, skip those done", file=sys.stderr)
+	print_("    already (same options, unchanged input) to resume a run", file=sys.stderr)
+	print_(" --quarantine FILE: Report -b inputs that failed or needed -t workarounds", file=sys.stderr)
+	print_(" -j, --jobs N: Number of parallel batch workers (def=no of CPUs)", file=sys.stderr)
+	print_(" -p, --parallel: Split one (large) changelog into chunks and convert them", file=sys.stderr)
+	print_("    in -j processes (regular input files, not with -m/--since/--until-version)", file=sys.stderr)
+	print_(" -W, --watch: Keep out (or the pairs below DIR, see -b) in sync with in,", file=sys.stderr)
+	print_("    only reparsing changed entries (inotify on Linux, else polling)", file=sys.stderr)
+	print_(" -u, --update: Only prepend entries newer than the newest one in out", file=sys.stderr)
+	print_(" -M, --merge: Sync in and out: Convert entries missing on either side", file=sys.stderr)
+	print_("    from the other, keep the others, report conflicts", file=sys.stderr)
+	print_(" --force: Write the missing entries (-M) despite conflicts", file=sys.stderr)
+	print_(" -k, --combine: Merge several changelogs (RPM/DEB/JSON mixed) into one by date,", file=sys.stderr)
+	print_("    dropping identical entries, streamed (-m limits the output)", file=sys.stderr)
+	print_(" -C, --check: Only report whether in and out are in sync (rc=1 if not)", file=sys.stderr)
+	print_(" -s, --stream: Convert entry by entry with constant memory", file=sys.stderr)
+	print_(" -z, --tzcache FILE: Load/store precomputed timezone index from/in FILE", file=sys.stderr)
+	print_(" -c, --cache: Reuse converted entries from ~/.changelog-transform/entrycache.sqlite", file=sys.stderr)
+	print_("    (regular input files, not with -m/--since/--until-version)", file=sys.stderr)
+	print_(" --cachesize MB: Limit the entry cache to MB megabytes of output (def=64)", file=sys.stderr)
+	print_(" -S, --stats: Output timings, counters and cache statistics to stderr", file=sys.stderr)
+	print_(" -J, --statsjson FILE: Write statistics as JSON to FILE", file=sys.stderr)
+	print_(" -P, --profile FILE: Write cProfile data to FILE (see pstats)", file=sys.stderr)
+	print_(" -D, --daemon: Serve conversion requests from changelog-client.py", file=sys.stderr)
+	print_(" --socket PATH: Unix socket for -D (def=$CHANGELOG_TRANSFORM_SOCKET", file=sys.stderr)
+	print_("    or ~/.changelog-transform/daemon.sock)", file=sys.stderr)
+	print_(" -I, --index: Add/update changelogs (files or found below dirs) in the index", file=sys.stderr)
+	print_(" -Q, --query: List indexed entries (at most -m) containing all WORDs and matching", file=sys.stderr)
+	print_("    pkg:NAME author:NAME|EMAIL version:VER urgency:URG since:DATE until:DATE", file=sys.stderr)
+	print_("    (DATE as YYYY-MM-DD[THH:MM[:SS]] local time)", file=sys.stderr)
+	print_(" --indexdb FILE: Index file (def=~/.changelog-transform/index.sqlite)", file=sys.stderr)
 	print_(" Options to fill in info for RPM->DEB conversions:", file=sys.stderr)
+	print_(" -K, --keywords FILE: Add urgency keywords (lines \"high:keyword\")", file=sys.stderr)
 	print_(" -V, --version x.y-r: Set initial version (def: ?-0)", file=sys.stderr)
 	print_(" -a, --emails LIST: provide list of mails \"NAME <adr> [, NAME <adr> [..]]]\"", file=sys.stderr)
 	print_(" -e, --emaildb: use .emaildb and for names", file=sys.stderr)
@@ -58,11 +142,14 @@ def parse_args(argv):
 	"Parse command line args"
 	import getopt
 	global quiet, verbose, infmt, outfmt, tolerant, joinln
-	global initver, dist, pkgnm, maxent, emails, emaildb, guessmail
+	global initver, dist, pkgnm, maxent, since, untilver, emails, emaildb, guessmail, tzcache, stream
+	global batchmode, jobs, incr, parallel, keywords, stats, statsjson, profile
+	global daemon, socknm, mergemode, force, check, entcache, cachesize
+	global indexmode, querymode, indexdb, watchmode, journal, quarantine, combinemode
 
 	# options
 	try:
-		optlist, args = getopt.gnu_getopt(argv, 'vqhi:o:trV:a:d:n:m:eE', ('help', 'quiet', 'verbose', 'tolerant', 'rewrap', 'infmt=', 'outfmt=', 'version=', 'distro=', 'pkgname=', 'maxent=', 'emails=', 'emaildb', 'emaildbguess'))
+		optlist, args = getopt.gnu_getopt(argv, 'vqhi:o:trV:a:d:n:m:eEz:csbj:upMCK:SJ:P:DIQWk', ('help', 'quiet', 'verbose', 'tolerant', 'rewrap', 'infmt=', 'outfmt=', 'version=', 'distro=', 'pkgname=', 'maxent=', 'since=', 'until-version=', 'emails=', 'emaildb', 'emaildbguess', 'tzcache=', 'cache', 'cachesize=', 'stream', 'batch', 'jobs=', 'update', 'parallel', 'merge', 'force', 'check', 'keywords=', 'stats', 'statsjson=', 'profile=', 'daemon', 'socket=', 'index', 'query', 'indexdb=', 'watch', 'journal=', 'quarantine=', 'combine'))
 	except getopt.GetoptError as exc:
 		print_(exc)
 		helpout(1)
@@ -88,10 +175,93 @@ def parse_args(argv):
 		if opt == '-m' or opt == '--maxent':
 			maxent = int(arg)
 			continue
+		if opt == '--since':
+			try:
+				since = parsedate(arg)
+			except ValueError as exc:
+				print_(exc)
+				helpout(1)
+			continue
+		if opt == '--until-version':
+			untilver = arg
+			continue
+		if opt == '-b' or opt == '--batch':
+			batchmode = True
+			continue
+		if opt == '--journal':
+			journal = arg
+			continue
+		if opt == '--quarantine':
+			quarantine = arg
+			continue
+		if opt == '-j' or opt == '--jobs':
+			jobs = int(arg)
+			continue
+		if opt == '-W' or opt == '--watch':
+			watchmode = True
+			continue
+		if opt == '-u' or opt == '--update':
+			incr = True
+			continue
+		if opt == '-p' or opt == '--parallel':
+			parallel = True
+			continue
+		if opt == '-M' or opt == '--merge':
+			mergemode = True
+			continue
+		if opt == '--force':
+			force = True
+			continue
+		if opt == '-k' or opt == '--combine':
+			combinemode = True
+			continue
+		if opt == '-C' or opt == '--check':
+			mergemode = True
+			check = True
+			continue
+		if opt == '-s' or opt == '--stream':
+			stream = True
+			continue
+		if opt == '-z' or opt == '--tzcache':
+			tzcache = arg
+			continue
+		if opt == '-c' or opt == '--cache':
+			entcache = True
+			continue
+		if opt == '--cachesize':
+			cachesize = int(arg)
+			continue
+		if opt == '-S' or opt == '--stats':
+			stats = True
+			continue
+		if opt == '-J' or opt == '--statsjson':
+			statsjson = arg
+			continue
+		if opt == '-P' or opt == '--profile':
+			profile = arg
+			continue
+		if opt == '-D' or opt == '--daemon':
+			daemon = True
+			continue
+		if opt == '--socket':
+			socknm = arg
+			continue
+		if opt == '-I' or opt == '--index':
+			indexmode = True
+			continue
+		if opt == '-Q' or opt == '--query':
+			querymode = True
+			continue
+		if opt == '--indexdb':
+			indexdb = arg
+			continue
 		# for RPM -> DEB
 		if opt == '-V' or opt == '--version':
 			initver = arg
 			continue
+		if opt == '-K' or opt == '--keywords':
+			keywords = arg
+			continue
 		if opt == '-a' or opt == '--emails':
 			for addr in arg.split(','):
 				email, name = parsemailaddr(addr)
@@ -112,21 +282,37 @@ def parse_args(argv):
 			continue
 		if opt == '-h' or opt == '--help':
 			helpout(0)
-	if len(args) != 3:
+	if querymode:
+		pass
+	elif indexmode:
+		if len(args) < 2:
+			helpout(1)
+	elif watchmode:
+		if len(args) not in (2, 3):
+			helpout(1)
+	elif combinemode:
+		if len(args) < 3:
+			helpout(1)
+	elif len(args) != (1 if daemon else 2 if batchmode else 3):
 		helpout(1)
 	return args[1:]
 
 EMAILDB = 'emaildb'
 GMAILDB = 'guessmaildb'
+EMAILSQL = 'emails.sqlite'
+CACHESQL = 'entrycache.sqlite'
 
 class emailsdb:
+	"""Email address -> name store, kept in an indexed sqlite database
+	   (tables emaildb and guessmaildb) that sqlite locks for concurrent
+	   access. The old flat files of the same names are imported once.
+	   Lookups are memoized, newly guessed names are collected and only
+	   written by flush()."""
 	def readdb(self, nm):
+		"Read old style flat file nm (if present)"
 		fullnm = self.pref+nm
 		emails = {}
-		if not os.access(os.path.dirname(fullnm), os.X_OK):
-			os.mkdir(os.path.dirname(fullnm), mode=0o750)
 		if not os.access(fullnm, os.R_OK):
-			open(fullnm, 'x').write('#EMail Address Database %s for changlog-transform.py\n' % nm)
 			return emails
 		fd = open(fullnm, 'r')
 		for ln in fd:
@@ -135,113 +321,1229 @@ class emailsdb:
 				continue
 			email, name = parsemailaddr(ln)
 			emails[email] = name
+		fd.close()
 		return emails
 	def __init__(self, pref=os.environ['HOME']+'/.changelog-transform/', guess=True):
 		self.pref = pref
-		self.emaildb = self.readdb(EMAILDB)
 		self.guess = guess
-		if guess:
-			self.guessmaildb = self.readdb(GMAILDB)
+		self.cache = {EMAILDB: {}, GMAILDB: {}}
+		self.pending = {}
+		self.pid = None
+		self.conn = None
+		if not os.access(os.path.dirname(self.pref+EMAILSQL), os.X_OK):
+			os.mkdir(os.path.dirname(self.pref+EMAILSQL), mode=0o750)
+		self.connect()
+	def connect(self):
+		"(Re)connect to the database, e.g. after a fork, create/import if needed"
+		import sqlite3
+		if self.conn and self.pid == os.getpid():
+			return self.conn
+		self.pid = os.getpid()
+		self.conn = sqlite3.connect(self.pref+EMAILSQL, timeout=60, isolation_level=None)
+		cur = self.conn.cursor()
+		cur.execute('BEGIN IMMEDIATE')
+		cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (GMAILDB,))
+		if not cur.fetchone():
+			for nm in (EMAILDB, GMAILDB):
+				cur.execute('CREATE TABLE %s (email TEXT PRIMARY KEY, name TEXT NOT NULL)' % nm)
+				cur.executemany('INSERT OR IGNORE INTO %s VALUES (?, ?)' % nm,
+						self.readdb(nm).items())
+		cur.execute('COMMIT')
+		return self.conn
+	def lookup(self, nm, email):
+		"Name for email in table nm (memoized), None if not found"
+		cache = self.cache[nm]
+		try:
+			name = cache[email]
+			changelog.stats.hit('emailcache')
+			return name
+		except KeyError:
+			pass
+		changelog.stats.miss('emailcache')
+		row = self.connect().execute('SELECT name FROM %s WHERE email=?' % nm, (email,)).fetchone()
+		cache[email] = row[0] if row else None
+		return cache[email]
+	def preload(self):
+		"Read all entries into the cache (e.g. before forking workers)"
+		for nm in (EMAILDB, GMAILDB):
+			for (email, name) in self.connect().execute('SELECT email, name FROM %s' % nm):
+				self.cache[nm][email] = name
+		return self
 	def addrappend(self, nm, addrs):
-		fullnm = self.pref+nm
-		fd = open(fullnm, 'a')
-		db = self.guessmaildb if nm == GMAILDB else self.emaildb
-		for it in addrs.keys():
-			val = db.get(it)
-			if val:
-				if val == addrs[it]:
-					continue
-				else:
-					raise ValueError("Will not overwrite %s <%s> with %s" % (val, it, addrs[it]))
-			print_("%s <%s>" % (addrs[it], it), file=fd)
-			db[it] = addrs[it]
+		"Store name(s) for address(es) in table nm"
+		cur = self.connect().cursor()
+		cur.execute('BEGIN IMMEDIATE')
+		try:
+			for it in addrs.keys():
+				row = cur.execute('SELECT name FROM %s WHERE email=?' % nm, (it,)).fetchone()
+				if row:
+					if row[0] == addrs[it]:
+						continue
+					else:
+						raise ValueError("Will not overwrite %s <%s> with %s" % (row[0], it, addrs[it]))
+				cur.execute('INSERT INTO %s VALUES (?, ?)' % nm, (it, addrs[it]))
+				self.cache[nm][it] = addrs[it]
+		except:
+			cur.execute('ROLLBACK')
+			raise
+		cur.execute('COMMIT')
 		return self
+	def flush(self):
+		"Write newly guessed names in one transaction"
+		if not self.pending:
+			return self
+		cur = self.connect().cursor()
+		cur.execute('BEGIN IMMEDIATE')
+		cur.executemany('INSERT OR IGNORE INTO %s VALUES (?, ?)' % GMAILDB, self.pending.items())
+		cur.execute('COMMIT')
+		self.pending = {}
+		return self
+	def version(self, guesses = True):
+		"""Identifies the state of the database (rows only get added),
+		   without guesses only that of the names given by the user"""
+		vers = [self.guess]
+		for nm in (EMAILDB, GMAILDB) if guesses else (EMAILDB,):
+			vers.extend(self.connect().execute('SELECT COUNT(*), MAX(rowid) FROM %s' % nm).fetchone())
+		return repr(vers)
 	def __getitem__(self, srch):
 		srch = srch.lower()
-		try:
-			nm = self.emaildb[srch]
-		except KeyError:
+		nm = self.lookup(EMAILDB, srch)
+		if nm is None:
+			changelog.stats.miss('emaildb')
 			nm = changelog.guessnm(srch)
 			if self.guess:
-				try:
-					nm = self.guessmaildb[srch]
-				except:
-					#nm = changelog.guessnm(srch)
+				gnm = self.lookup(GMAILDB, srch)
+				if gnm is None:
 					print_("WARN: Add %s <%s> to guessmaildb" % (nm, srch), file=sys.stderr)
-					self.addrappend(GMAILDB, {srch: nm})
+					self.pending[srch] = nm
+					self.cache[GMAILDB][srch] = nm
+					changelog.stats.miss('guessmaildb')
+					changelog.stats.count('names_guessed')
+				else:
+					nm = gnm
+					changelog.stats.hit('guessmaildb')
 			else:
 				raise ValueError('No such email %s <%s>' % (nm, srch))
+		else:
+			changelog.stats.hit('emaildb')
 		return nm
 
-def main(argv):
-	global infmt, outfmt, pkgnm, emails
-	innm, outnm = parse_args(argv)
-	if not infmt:
-		if innm[-8:] == ".changes":
-			infmt = "rpm"
-		elif innm[-10:] == ".changelog":
-			infmt = "deb"
+def flushemails():
+	"Write back newly guessed names, if we use the db"
+	if isinstance(emails, emailsdb):
+		emails.flush()
+
+def emailsversion():
+	"Identifies the email -> name mappings in use (for the entry cache)"
+	if isinstance(emails, emailsdb):
+		return emails.version()
+	return repr(sorted(emails.items()))
+
+entrycache = None
+
+def openentrycache():
+	"The (global) entry cache, opened on first use"
+	global entrycache
+	if not entrycache:
+		pref = os.environ['HOME']+'/.changelog-transform/'
+		if not os.access(pref, os.X_OK):
+			os.mkdir(pref, 0o750)
+		entrycache = changelog.entrycache(pref+CACHESQL, cachesize<<20)
+	return entrycache
+
+COMPRESSORS = (('.gz', 'gzip'), ('.bz2', 'bz2'), ('.xz', 'lzma'))
+TARSUFFIXES = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+CPIOSUFFIXES = ('.cpio', '.cpio.gz', '.cpio.bz2', '.cpio.xz', '.obscpio', '.obscpio.gz', '.obscpio.bz2', '.obscpio.xz')
+
+def compression(nm):
+	"Name of the module to (de)compress file nm with (by suffix) or None"
+	for (suff, mod) in COMPRESSORS:
+		if nm[-len(suff):] == suff:
+			return mod
+	return None
+
+def splitarchive(nm):
+	"""(archive, member) for ARCHIVE[:MEMBER] names (member may be None),
+	   (None, nm) for anything else"""
+	idx = nm.find(':')
+	for arch in (nm, nm[0:idx] if idx > 0 else None):
+		if arch and arch.endswith(TARSUFFIXES + CPIOSUFFIXES):
+			return (arch, nm[len(arch)+1:] or None)
+	return (None, nm)
+
+def plainfile(nm):
+	"Uncompressed file (not stdin, no archive member)?"
+	return nm != '-' and not compression(nm) and not splitarchive(nm)[0]
+
+def basenm(nm):
+	"Changelog file name: member name for archives, w/o compression suffix"
+	nm = splitarchive(nm)[1] or ''
+	if compression(nm):
+		nm = nm[0:nm.rfind('.')]
+	return nm
+
+def bopen(nm, mode = 'rb'):
+	"Open (possibly compressed) file nm in binary mode"
+	mod = compression(nm)
+	if mod:
+		return __import__(mod).open(nm, mode)
+	return open(nm, mode)
+
+class memberfile(io.TextIOWrapper):
+	"Text stream of an archive member, closes the archive with it"
+	def __init__(self, fd, members):
+		io.TextIOWrapper.__init__(self, fd, encoding = 'utf-8')
+		self.members = members
+	def close(self):
+		io.TextIOWrapper.close(self)
+		self.members.close()
+
+class boundedreader(io.RawIOBase):
+	"Read at most size bytes from fd"
+	def __init__(self, fd, size):
+		self.fd = fd
+		self.left = size
+	def readable(self):
+		return True
+	def readinto(self, buf):
+		data = self.fd.read(min(len(buf), self.left))
+		buf[0:len(data)] = data
+		self.left -= len(data)
+		return len(data)
+	def skip(self):
+		"Read and drop the rest"
+		while self.left and self.readinto(bytearray(min(self.left, 65536))):
+			pass
+
+def cpiomembers(fd):
+	"""Generator: (name, binary stream) for the members of (newc) cpio
+	   archive stream fd, e.g. OBS .obscpio files. Reads sequentially, so
+	   a member needs to be read before asking for the next one."""
+	while True:
+		hdr = fd.read(110)
+		if len(hdr) < 110 or hdr[0:5] != b'07070' or hdr[5:6] not in (b'1', b'2'):
+			raise ValueError("Not a (newc) cpio archive")
+		size = int(hdr[54:62], 16)
+		namesz = int(hdr[94:102], 16)
+		name = fd.read(namesz)[0:-1].decode('utf-8', 'replace')
+		fd.read((4 - (110+namesz) % 4) % 4)
+		if name == 'TRAILER!!!':
+			return
+		member = boundedreader(fd, size)
+		yield (name, io.BufferedReader(member))
+		member.skip()
+		fd.read((4 - size % 4) % 4)
+
+def archivemembers(arch):
+	"Generator: (name, binary stream) for the regular files in tar or cpio archive arch"
+	if arch.endswith(TARSUFFIXES):
+		import tarfile
+		try:
+			tar = tarfile.open(arch, 'r|*')
+			try:
+				for info in tar:
+					if info.isfile():
+						# Streamed members can not tell whether they're seekable
+						yield (info.name, io.BufferedReader(boundedreader(tar.extractfile(info), info.size)))
+			finally:
+				tar.close()
+		except tarfile.TarError as exc:
+			raise ValueError("%s: %s" % (arch, exc))
+	else:
+		fd = bopen(arch)
+		try:
+			for mem in cpiomembers(fd):
+				yield mem
+		finally:
+			fd.close()
+
+def ischangelog(nm, fmt = None):
+	"Could file nm be a changelog in format fmt (None=RPM or DEB)?"
+	fmt2 = guessfmt(nm)
+	if fmt is None:
+		return fmt2 in ('rpm', 'deb')
+	return fmt2 == fmt
+
+def findmember(arch, fmt = None):
+	"Name of first changelog (in format fmt) in archive arch"
+	members = archivemembers(arch)
+	for (name, fd) in members:
+		if ischangelog(name, fmt):
+			members.close()
+			return name
+	raise ValueError("No %schangelog found in %s" % (fmt + ' ' if fmt else '', arch))
+
+def resolveinput(nm, outnm):
+	"""Input name as ARCHIVE:MEMBER with the member filled in if not given,
+	   preferring the format we don't convert to"""
+	(arch, member) = splitarchive(nm)
+	if arch and not member:
+		fmt = infmt or {'rpm': 'deb', 'deb': 'rpm'}.get(outfmt or guessfmt(outnm))
+		return '%s:%s' % (arch, findmember(arch, fmt))
+	return nm
+
+def openinput(nm):
+	"""Open input nm as text stream: stdin (-), plain or compressed file,
+	   or ARCHIVE:MEMBER, all read sequentially"""
+	if nm == '-':
+		return sys.stdin
+	(arch, member) = splitarchive(nm)
+	if not arch:
+		return io.TextIOWrapper(bopen(nm), encoding = 'utf-8')
+	members = archivemembers(arch)
+	for (name, fd) in members:
+		if name == member:
+			return memberfile(fd, members)
+	raise IOError("No member %s in %s" % (member, arch))
+
+def openoutput(nm):
+	"Open output nm as text stream: stdout (-), plain or compressed file"
+	if nm == '-':
+		return sys.stdout
+	if splitarchive(nm)[0]:
+		raise IOError("Can not write into archive %s" % nm)
+	if compression(nm):
+		return io.TextIOWrapper(bopen(nm, 'wb'), encoding = 'utf-8')
+	return open(nm, 'w')
+
+def guessfmt(nm):
+	"Determine changelog format from file name"
+	nm = basenm(nm)
+	if nm[-8:] == ".changes":
+		return "rpm"
+	elif nm[-10:] == ".changelog" or nm[-16:] == "debian/changelog":
+		return "deb"
+	elif nm[-5:] == ".json":
+		return "json"
+	elif nm[-7:] == ".ndjson" or nm[-6:] == ".jsonl":
+		return "ndjson"
+	return None
+
+def guesspkgnm(innm, outnm, infmt):
+	"Derive package name from file names"
+	innm = basenm(innm)
+	outnm = basenm(outnm)
+	idx = innm.rfind('.')
+	if idx > 0:
+		return os.path.basename(innm[0:idx])
+	idx = outnm.rfind('.')
+	if idx > 0:
+		return os.path.basename(outnm[0:idx])
+	if infmt == 'rpm':
+		print_("WARN: Can not determine package name format", file=sys.stderr)
+	return ''
+
+def textiter(chglog, fd, fmt, maxent = 0, filt = None):
+	"Entry generator for text stream fd in format fmt"
+	if fmt == 'rpm':
+		return chglog.rpmiter(fd, joinln, tolerant, maxent, filt)
+	elif fmt == 'deb':
+		return chglog.debiter(fd, joinln, tolerant, maxent, filt)
+	return chglog.jsoniter(fd, maxent, filt)
+
+def window():
+	"changelog.entryfilter for --since/--until-version, None if not used"
+	if since is None and not untilver:
+		return None
+	return changelog.entryfilter(since, untilver)
+
+def openiter(chglog, innm, infmt, maxent = 0, filt = None):
+	"""Open input, return (fd, entry generator). Regular RPM/DEB files get
+	   memory mapped, stdin, compressed files, archive members, JSON and
+	   other non-seekable files are read line by line.
+	   filt: Stop at the first entry outside this changelog.entryfilter."""
+	if plainfile(innm) and infmt in ('rpm', 'deb'):
+		infd = open(innm, 'rb')
+		if changelog.ismappable(infd):
+			return (infd, changelog.stats.timeiter(chglog.mapiter(infd, infmt, joinln, tolerant, maxent, filt = filt), 'split'))
+		infd.close()
+	infd = openinput(innm)
+	return (infd, changelog.stats.timeiter(textiter(chglog, infd, infmt, maxent, filt), 'read'))
+
+def convert(innm, outnm, infmt, outfmt, pkgnm):
+	"Convert changelog innm into outnm, return number of entries"
+	chglog = changelog.changelog(pkgnm = pkgnm, distover = dist, initver = initver, emaildb = emails, diags = problems)
+	filt = window()
+	# Those need to find all entries first
+	whole = infmt in ('rpm', 'deb') and outfmt in ('rpm', 'deb') and plainfile(innm) and not maxent and not filt
+	if entcache and whole:
+		nent = cachedconvert(innm, outnm, infmt, outfmt, pkgnm)
+		if nent is not None:
+			return nent
+	if parallel and whole:
+		nent = parconvert(chglog, innm, outnm, infmt, outfmt)
+		if nent is not None:
+			return nent
+	(infd, entries) = openiter(chglog, innm, infmt, maxent, filt)
+	# NDJSON is for consumers that want entries as soon as they are parsed
+	streaming = stream or outfmt == 'ndjson'
+	if streaming:
+		entries = countiter(entries)
+	else:
+		chglog.entries.extend(entries)
+		entries = None
+		infd.close()
+
+	outfd = openoutput(outnm)
+	chglog.write(outfd, outfmt, entries)
+
+	if streaming:
+		infd.close()
+	outfd.close()
+
+	return entries.count if streaming else len(chglog.entries)
+
+def cachedconvert(innm, outnm, infmt, outfmt, pkgnm, cache = None):
+	"""Convert using the entry cache (or cache, e.g. a changelog.memcache),
+	   return number of entries or None if innm is not suitable"""
+	infd = open(innm, 'rb')
+	if not changelog.ismappable(infd):
+		infd.close()
+		return None
+	chglog = changelog.lazychangelog(infd, infmt, joinln, tolerant, pkgnm = pkgnm,
+					 distover = dist, initver = initver, emaildb = emails, diags = problems)
+	outfd = openoutput(outnm)
+	if cache is None:
+		cache = openentrycache()
+	nent = chglog.cachedwrite(outfd, outfmt, cache, emailsversion())
+	cache.flush()
+	infd.close()
+	outfd.close()
+	return nent
+
+def parconvert(chglog, innm, outnm, infmt, outfmt):
+	"""Convert in chunks with -j processes, return number of entries
+	   or None if innm is not suitable"""
+	import multiprocessing
+	infd = open(innm, 'rb')
+	if not changelog.ismappable(infd):
+		infd.close()
+		return None
+	outfd = openoutput(outnm)
+	nent = chglog.parconvert(infd, infmt, outfd, outfmt, joinln, tolerant,
+				 jobs or multiprocessing.cpu_count())
+	infd.close()
+	outfd.close()
+	return nent
+
+def combine(innms, outnm):
+	"""Merge the changelogs innms into outnm (see changelog.mergeentries()),
+	   reading all of them in parallel, entry by entry.
+	   Returns number of entries written."""
+	import itertools
+	ofmt = outfmt or guessfmt(outnm)
+	if ofmt not in changelog.FORMATS:
+		raise ValueError("Can not determine output format")
+	ins = []
+	for innm in innms:
+		innm = resolveinput(innm, outnm)
+		ifmt = infmt or guessfmt(innm)
+		if ifmt not in changelog.FORMATS:
+			raise ValueError("Can not determine format of %s" % innm)
+		ins.append((innm, ifmt))
+	# RPM entries get the package name, from the RPM file names like convert()
+	pnm = pkgnm
+	if not pnm:
+		names = sorted(set(guesspkgnm(innm, outnm, ifmt) for (innm, ifmt) in ins if ifmt == 'rpm'))
+		if len(names) > 1:
+			raise ValueError("Inputs are for different packages (%s), use -n" % ', '.join(names))
+		pnm = names[0] if names else guesspkgnm(ins[0][0], outnm, ins[0][1])
+	chglog = changelog.changelog(pkgnm = pnm, distover = dist, initver = initver, emaildb = emails, diags = problems)
+	fds = []
+	streams = []
+	try:
+		for (innm, ifmt) in ins:
+			(infd, entries) = openiter(chglog, innm, ifmt, 0, window())
+			fds.append(infd)
+			streams.append(entries)
+		entries = countiter(itertools.islice(changelog.mergeentries(streams), maxent or None))
+		outfd = openoutput(outnm)
+		chglog.write(outfd, ofmt, entries)
+		outfd.close()
+	finally:
+		for infd in fds:
+			infd.close()
+	return entries.count
+
+def tmpname(nm):
+	"Temporary name next to file nm (keeping a compression suffix)"
+	if compression(nm):
+		idx = nm.rfind('.')
+		return '%s.%i%s' % (nm[0:idx], os.getpid(), nm[idx:])
+	return '%s.%i' % (nm, os.getpid())
+
+def update(innm, outnm, infmt, outfmt, pkgnm):
+	"""Prepend the entries newer than the newest one in outnm to it,
+	   return number of new entries"""
+	import shutil
+	if outnm == '-' or not os.path.exists(outnm) or not os.path.getsize(outnm):
+		return convert(innm, outnm, infmt, outfmt, pkgnm)
+	if outfmt == 'json':
+		raise ValueError("Can not prepend to a JSON array, use NDJSON")
+	tgt = changelog.changelog(pkgnm = pkgnm, distover = dist, diags = problems)
+	outfd = openinput(outnm)
+	tgt.entries.extend(textiter(tgt, outfd, outfmt, 1))
+	outfd.close()
+	newest = tgt.entries[0]
+
+	chglog = changelog.changelog(pkgnm = pkgnm, distover = dist, initver = initver, emaildb = emails, diags = problems)
+	if outfmt == 'deb':
+		chglog.initver = newest.vers
+	(infd, entries) = openiter(chglog, innm, infmt)
+	chglog.newerthan(entries, newest)
+	entries.close()
+	infd.close()
+	if not chglog.entries:
+		return 0
+
+	compr = compression(outnm)
+	tmpnm = tmpname(outnm)
+	tmpfd = openoutput(tmpnm)
+	chglog.write(tmpfd, outfmt)
+	if compr:
+		# Recompress the old entries behind the new ones
+		outfd = openinput(outnm)
+	else:
+		tmpfd.close()
+		tmpfd = open(tmpnm, 'ab')
+		outfd = open(outnm, 'rb')
+	shutil.copyfileobj(outfd, tmpfd)
+	outfd.close()
+	tmpfd.close()
+	shutil.copymode(outnm, tmpnm)
+	os.rename(tmpnm, outnm)
+	return len(chglog.entries)
+
+def merge(innm, outnm, infmt, outfmt, pkgnm):
+	"""Sync the RPM and DEB changelogs innm and outnm: Entries only found
+	   in one of them (by date and email) are converted and inserted into
+	   the other one, entries found in both are left untouched (text and
+	   DEB version, distribution, urgency). Differing texts of matching
+	   entries are reported as conflicts, nothing is written then unless
+	   we force it. Entries are matched and compared on their raw text,
+	   they are only parsed if that does not match or for converting.
+	   With check, nothing is written. Returns number of differences
+	   (with check) or conflicts."""
+	import shutil
+	names = {infmt: innm, outfmt: outnm}
+	for nm in (innm, outnm):
+		if not plainfile(nm):
+			raise IOError("Can only merge uncompressed files, not %s" % nm)
+	logs = {}
+	for fmt in ('rpm', 'deb'):
+		if os.path.exists(names[fmt]):
+			fd = open(names[fmt], 'rb')
 		else:
-			print_("ERROR: Can not determine input format", file=sys.stderr)
-			sys.exit(2)
-	if not outfmt:
-		if outnm[-8:] == ".changes":
-			outfmt = "rpm"
-		elif outnm[-10:] == ".changelog":
-			outfmt = "deb"
+			fd = io.BytesIO()
+		# Strict parsing: We rewrite the files and must not drop anything
+		logs[fmt] = changelog.lazychangelog(fd, fmt, joinln, False, pkgnm = pkgnm,
+						    distover = dist, initver = initver, emaildb = emails)
+	(rpms, debs) = (logs['rpm'], logs['deb'])
+	pairs = changelog.pairentries([rpms.stamp(idx) for idx in range(len(rpms))],
+				      [debs.stamp(idx) for idx in range(len(debs))])
+	nconfl = 0
+	nmiss = {'rpm': 0, 'deb': 0}
+	for (ridx, didx) in pairs:
+		if ridx is None or didx is None:
+			ent = debs[didx] if ridx is None else rpms[ridx]
+			fmt = 'rpm' if ridx is None else 'deb'
+			nmiss[fmt] += 1
+			if check:
+				print_("MISSING in %s: %s - %s" % (names[fmt], ent.date, ent.email))
+		elif (rpms.rawitemtext(ridx) != debs.rawitemtext(didx)
+		      and rpms[ridx].text() != debs[didx].text()):
+			print_("CONFLICT: Entry %s - %s differs" % (rpms[ridx].date, rpms[ridx].email), file=sys.stderr)
+			nconfl += 1
+	if check:
+		return nconfl + nmiss['rpm'] + nmiss['deb']
+	if nconfl and not force and (nmiss['rpm'] or nmiss['deb']):
+		print_("ERROR: Not writing %s, resolve the conflicts first (or use --force)"
+		       % ' and '.join(names[fmt] for fmt in ('rpm', 'deb') if nmiss[fmt]), file=sys.stderr)
+		return nconfl
+	if nmiss['deb']:
+		# New DEB entries: Versions from older ones, name from the DEB side
+		debents = []
+		for (ridx, didx) in pairs:
+			if didx is None:
+				ent = rpms[ridx]
+				if len(debs):
+					ent.pkgnm = debs[0].pkgnm
+				debents.append(ent)
+			else:
+				debents.append(debs[didx])
+		debs.fixupdebver(debents)
+	for (fmt, side) in (('rpm', 0), ('deb', 1)):
+		if not nmiss[fmt]:
+			continue
+		tmpnm = '%s.%i' % (names[fmt], os.getpid())
+		tmpfd = open(tmpnm, 'w')
+		for (num, pair) in enumerate(pairs):
+			if pair[side] is not None:
+				txt = logs[fmt].rawtext(pair[side])
+				if num+1 < len(pairs) and txt[-2:] != '\n\n':
+					txt += '\n' if txt[-1:] == '\n' else '\n\n'
+			elif fmt == 'rpm':
+				txt = debs[pair[1]].rpmout()
+			else:
+				txt = rpms[pair[0]].debout()
+			tmpfd.write(txt)
+		tmpfd.close()
+		if os.path.exists(names[fmt]):
+			shutil.copymode(names[fmt], tmpnm)
+		os.rename(tmpnm, names[fmt])
+		if not quiet:
+			print_("Added %i entries to %s" % (nmiss[fmt], names[fmt]), file=sys.stderr)
+	for log in (rpms, debs):
+		log.fd.close()
+	return nconfl
+
+class countiter:
+	"Iterator wrapper counting the items passed through"
+	def __init__(self, it):
+		self.it = iter(it)
+		self.count = 0
+	def __iter__(self):
+		return self
+	def __next__(self):
+		obj = next(self.it)
+		self.count += 1
+		return obj
+	next = __next__
+
+def findpairs(topdir):
+	"""Walk OBS checkout for .changes/debian.changelog pairs.
+	   Returns list of (in, out) according to the conversion direction."""
+	pairs = []
+	todeb = infmt != 'deb' and outfmt != 'rpm'
+	for (dirnm, subdirs, files) in os.walk(topdir):
+		subdirs[:] = sorted(sd for sd in subdirs if sd[0] != '.')
+		chgs = sorted(f for f in files if basenm(f)[-8:] == '.changes')
+		deb = os.path.join(dirnm, 'debian.changelog')
+		if not chgs:
+			if not todeb and 'debian.changelog' in files:
+				chg = os.path.basename(os.path.abspath(dirnm)) + '.changes'
+				pairs.append((deb, os.path.join(dirnm, chg)))
+			continue
+		if len(chgs) > 1:
+			chg = os.path.basename(os.path.abspath(dirnm)) + '.changes'
+			if chg not in chgs:
+				print_("WARN: Skipping %s: Multiple .changes files" % dirnm, file=sys.stderr)
+				continue
 		else:
-			print_("ERROR: Can not determine output format", file=sys.stderr)
-			sys.exit(2)
-	if not pkgnm:
-		idx = innm.rfind('.')
-		if idx > 0:
-			pkgnm = os.path.basename(innm[0:idx])
+			chg = chgs[0]
+		chg = os.path.join(dirnm, chg)
+		if todeb:
+			pairs.append((chg, deb))
+		elif 'debian.changelog' in files:
+			pairs.append((deb, chg))
+	return pairs
+
+def readmanifest(nm):
+	"Read list of in out pairs (relative to manifest location)"
+	pairs = []
+	base = os.path.dirname(nm)
+	for ln in open(nm, 'r'):
+		ln = ln.strip()
+		if not ln or ln[0] == '#':
+			continue
+		try:
+			(innm, outnm) = ln.split()
+		except ValueError:
+			raise ValueError("Invalid manifest line \"%s\"" % ln)
+		pairs.append((os.path.join(base, innm), os.path.join(base, outnm)))
+	return pairs
+
+def batchopts():
+	"""Options that influence the results of batchconv() (for the journal).
+	   Of the email -> name mappings only those given by the user count,
+	   guessing names does not invalidate the journal for the next run."""
+	if isinstance(emails, emailsdb):
+		names = emails.version(False)
+	else:
+		names = repr(sorted(emails.items()))
+	return repr((infmt, outfmt, incr, tolerant, joinln, initver, dist, pkgnm,
+		     maxent, since, untilver, keywords, emaildb, guessmail, names))
+
+def batchconv(pair):
+	"""Worker: Convert one pair, return journal record (dict) with in, out,
+	   src (resolved in), stat (of in before converting), opts, ok,
+	   error, entries, diags (problems worked around with -t), secs and
+	   stats (changelog.stats snapshot or None, not for the journal)"""
+	import time
+	(innm, outnm) = pair
+	start = time.time()
+	rec = {'in': innm, 'out': outnm, 'src': innm, 'stat': fstat(splitarchive(innm)[0] or innm),
+	       'opts': batchopts(), 'ok': False, 'error': None, 'entries': 0, 'stats': None}
+	changelog.stats.reset()
+	del problems[:]
+	try:
+		innm = rec['src'] = resolveinput(innm, outnm)
+		ifmt = infmt or guessfmt(innm)
+		ofmt = outfmt or guessfmt(outnm)
+		if not ifmt or not ofmt:
+			raise ValueError("Can not determine format")
+		pnm = pkgnm or guesspkgnm(innm, outnm, ifmt)
+		rec['entries'] = (update if incr else convert)(innm, outnm, ifmt, ofmt, pnm)
+		flushemails()
+		rec['ok'] = True
+		if changelog.stats.enabled:
+			rec['stats'] = changelog.stats.snapshot()
+	except (changelog.ParseError, ValueError, IOError, OSError) as exc:
+		rec['error'] = str(exc)
+	rec['diags'] = list(problems)
+	rec['secs'] = time.time()-start
+	return rec
+
+def readjournal(nm):
+	"Last journal record for each (in, out) pair in journal nm"
+	import json
+	recs = {}
+	if not os.path.exists(nm):
+		return recs
+	for ln in open(nm, 'r'):
+		try:
+			rec = json.loads(ln)
+			recs[(rec['in'], rec['out'])] = rec
+		except (ValueError, KeyError, TypeError):
+			# e.g. last line of an interrupted run
+			continue
+	return recs
+
+def isdone(rec, opts):
+	"Did journal record rec convert its (unchanged) input with opts?"
+	if not rec or not rec['ok'] or rec['opts'] != opts or not os.path.exists(rec['out']):
+		return False
+	stat = fstat(splitarchive(rec['in'])[0] or rec['in'])
+	return stat is not None and rec['stat'] == list(stat)
+
+def writequarantine(nm, recs):
+	"Report the failed inputs and those with problems from the journal records recs"
+	fd = open(nm, 'w')
+	for rec in recs:
+		if rec['ok'] and not rec['diags']:
+			continue
+		if rec['ok']:
+			fd.write("WARN %s -> %s: %i problems worked around\n" % (rec['src'], rec['out'], len(rec['diags'])))
 		else:
-			idx = outnm.rfind('.')
-			if idx > 0:
-				pkgnm = os.path.basename(outnm[0:idx])
-			elif infmt == 'rpm':
-				print_("WARN: Can not determine package name format", file=sys.stderr)
-
-	if innm == '-':
-		infd = sys.stdin
+			fd.write("FAIL %s -> %s: %s\n" % (rec['src'], rec['out'], rec['error']))
+		for (action, msg) in rec['diags']:
+			fd.write("     %s: %s\n" % (action, msg))
+	fd.close()
+
+def batch(src):
+	"""Convert many changelogs in a worker pool. With a journal, pairs
+	   converted by an earlier run (with the same options and inputs)
+	   are skipped."""
+	import json
+	import multiprocessing
+	import time
+	if os.path.isdir(src):
+		pairs = findpairs(src)
 	else:
-		infd = open(innm, 'r')
+		pairs = readmanifest(src)
+	opts = batchopts()
+	recs = readjournal(journal) if journal else {}
+	todo = [pair for pair in pairs if not isdone(recs.get(pair), opts)]
+	if len(todo) < len(pairs) and not quiet:
+		print_("Resuming: %i of %i files done already" % (len(pairs)-len(todo), len(pairs)))
+	jfd = open(journal, 'a') if journal else None
+	# Warm up shared state before forking workers
+	changelog.tzidx.ensure()
+	nproc = jobs or multiprocessing.cpu_count()
+	start = time.time()
+	pool = multiprocessing.get_context('fork').Pool(min(nproc, max(len(todo), 1)))
+	nok = len(pairs) - len(todo)
+	nent = 0
+	for rec in pool.imap_unordered(batchconv, todo):
+		snap = rec.pop('stats')
+		if snap:
+			changelog.stats.merge(snap)
+		recs[(rec['in'], rec['out'])] = rec
+		if jfd:
+			jfd.write(json.dumps(rec) + '\n')
+			jfd.flush()
+		if not rec['ok']:
+			print_("FAIL %s -> %s: %s" % (rec['src'], rec['out'], rec['error']))
+			continue
+		nok += 1
+		nent += rec['entries']
+		if not quiet:
+			warn = ", %i problems" % len(rec['diags']) if rec['diags'] else ""
+			print_("OK   %s -> %s (%i entries%s, %.2fs)" % (rec['src'], rec['out'], rec['entries'], warn, rec['secs']))
+	pool.close()
+	pool.join()
+	if jfd:
+		jfd.close()
+	if quarantine:
+		writequarantine(quarantine, [recs[pair] for pair in pairs if pair in recs])
+	secs = time.time() - start
+	print_("Converted %i/%i files, %i entries in %.2fs (%.1f files/s, %.1f entries/s)"
+		% (nok, len(pairs), nent, secs, len(todo)/secs, nent/secs))
+	return 0 if nok == len(pairs) else 1
+
+def indexfile(index, path):
+	"""(Re)index changelog file path if it changed,
+	   return number of entries or None if unchanged"""
+	stat = os.stat(path)
+	if index.known(path, stat.st_mtime, stat.st_size):
+		return None
+	fd = open(path, 'rb')
+	hsh = changelog.entryindex.filehash(fd)
+	fd.close()
+	if index.samehash(path, stat.st_mtime, stat.st_size, hsh):
+		return None
+	fmt = infmt or guessfmt(path)
+	if not fmt:
+		raise ValueError("Can not determine format")
+	chglog = changelog.changelog(pkgnm = guesspkgnm(path, '', fmt) if fmt == 'rpm' else None,
+				     emaildb = emails)
+	(infd, entries) = openiter(chglog, path, fmt)
+	ents = list(entries)
+	infd.close()
+	index.store(path, stat.st_mtime, stat.st_size, hsh, fmt, ents)
+	return len(ents)
+
+def findchangelogs(topdir):
+	"All changelog files below topdir (absolute paths)"
+	paths = []
+	for (dirnm, subdirs, files) in os.walk(os.path.abspath(topdir)):
+		subdirs[:] = sorted(sd for sd in subdirs if sd[0] != '.')
+		paths.extend(os.path.join(dirnm, f) for f in sorted(files)
+			     if ischangelog(os.path.join(dirnm, f)))
+	return paths
+
+def indexfiles(nms):
+	"""Add/update changelogs nms (files or dirs) in the index; files gone
+	   from indexed dirs get dropped"""
+	import time
+	start = time.time()
+	index = changelog.entryindex(indexdb)
+	nfiles = 0
+	nent = 0
+	nfail = 0
+	for nm in nms:
+		if os.path.isdir(nm):
+			paths = findchangelogs(nm)
+			gone = set(index.files(os.path.abspath(nm) + os.sep)) - set(paths)
+			index.remove(sorted(gone))
+			if gone and not quiet:
+				print_("DROP %i files gone from %s" % (len(gone), nm))
+		else:
+			paths = [os.path.abspath(nm)]
+		for path in paths:
+			try:
+				ents = indexfile(index, path)
+			except (changelog.ParseError, ValueError, IOError, OSError) as exc:
+				print_("FAIL %s: %s" % (path, exc))
+				nfail += 1
+				continue
+			if ents is None:
+				continue
+			nfiles += 1
+			nent += ents
+			if not quiet:
+				print_("OK   %s (%i entries)" % (path, ents))
+	flushemails()
+	print_("Indexed %i changed files, %i entries in %.2fs" % (nfiles, nent, time.time()-start))
+	return 1 if nfail else 0
+
+QUERYFIELDS = ('pkg', 'author', 'version', 'urgency', 'since', 'until')
+
+def parsedate(strg):
+	"POSIX timestamp for local time YYYY-MM-DD[THH:MM[:SS]]"
+	import datetime
+	import time
+	for fmt in ('%Y-%m-%d', '%Y-%m-%dT%H:%M', '%Y-%m-%dT%H:%M:%S'):
+		try:
+			return time.mktime(datetime.datetime.strptime(strg, fmt).timetuple())
+		except ValueError:
+			pass
+	raise ValueError("Invalid date \"%s\"" % strg)
+
+def query(terms):
+	"Output the indexed entries matching terms (words and field:value filters)"
+	words = []
+	filt = {}
+	for term in terms:
+		(field, sep, val) = term.partition(':')
+		if sep and field in QUERYFIELDS:
+			filt[field] = val
+		else:
+			words.append(term)
+	try:
+		since = parsedate(filt['since']) if 'since' in filt else None
+		until = parsedate(filt['until']) if 'until' in filt else None
+	except ValueError as exc:
+		print_("ERROR: %s" % exc, file=sys.stderr)
+		return 2
+	index = changelog.entryindex(indexdb)
+	rows = index.query(words, filt.get('pkg'), filt.get('author'), filt.get('version'),
+			   filt.get('urgency'), since, until, maxent)
+	lwords = [word.lower() for word in words]
+	for (path, pos, pkg, vers, datestr, email, authnm, urg, text) in rows:
+		print_("%s %s %s (%s) %s <%s>  %s#%i" % (datestr[0:10], pkg, vers or '-', urg, authnm, email, path, pos+1))
+		lines = text.split('\n')
+		hits = [ln for ln in lines if any(word in ln.lower() for word in lwords)]
+		for ln in (hits or lines)[0:3]:
+			print_("    %s" % ln)
+	return 0 if rows else 1
+
+class dirwatcher:
+	"""Wait for changes in directories: inotify(7) (via libc) on Linux,
+	   else wake up every POLLINT seconds and let the caller compare
+	   file stats"""
+	POLLINT = 1.0
+	# IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+	MASK = 0x2 | 0x4 | 0x8 | 0x40 | 0x80 | 0x100 | 0x200
+	def __init__(self):
+		import ctypes
+		self.fd = None
+		self.dirs = set()
+		try:
+			self.libc = ctypes.CDLL(None, use_errno = True)
+			fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+		except (OSError, AttributeError):
+			return
+		if fd >= 0:
+			self.fd = fd
+	def watch(self, dirnm):
+		"Watch directory dirnm (again)"
+		if self.fd is None or dirnm in self.dirs:
+			return
+		if self.libc.inotify_add_watch(self.fd, os.fsencode(dirnm), self.MASK) >= 0:
+			self.dirs.add(dirnm)
+	def wait(self, timeout = None):
+		"""Wait up to timeout secs (None: until something changed or
+		   POLLINT without inotify), return False on timeout"""
+		import select
+		import time
+		if self.fd is None:
+			time.sleep(self.POLLINT if timeout is None else min(timeout, self.POLLINT))
+			return True
+		if not select.select([self.fd], [], [], timeout)[0]:
+			return False
+		# Events only wake us up, the caller looks at the files
+		try:
+			while os.read(self.fd, 65536):
+				pass
+		except BlockingIOError:
+			pass
+		# Deleted/moved away dirs lose their watch
+		self.dirs = set(nm for nm in self.dirs if os.path.isdir(nm))
+		return True
+	def close(self):
+		if self.fd is not None:
+			os.close(self.fd)
 
+def fstat(nm):
+	"(mtime, size) of file nm, None if it does not exist"
+	try:
+		stat = os.stat(nm)
+	except OSError:
+		return None
+	return (stat.st_mtime, stat.st_size)
+
+def watchconv(innm, outnm, cache):
+	"""Convert innm to outnm for the watch mode, atomically replacing
+	   outnm. RPM/DEB conversions are done with cachedconvert() with
+	   the (per input file) cache, so only changed entries get parsed.
+	   Return number of entries."""
+	ifmt = infmt or guessfmt(innm)
+	ofmt = outfmt or guessfmt(outnm)
+	if not ifmt or not ofmt:
+		raise ValueError("Can not determine format")
+	pnm = pkgnm or guesspkgnm(innm, outnm, ifmt)
+	tmpnm = tmpname(outnm)
+	try:
+		nent = None
+		if ifmt in ('rpm', 'deb') and ofmt in ('rpm', 'deb') and plainfile(innm) and not maxent and not window():
+			nent = cachedconvert(innm, tmpnm, ifmt, ofmt, pnm, cache)
+		if nent is None:
+			nent = convert(innm, tmpnm, ifmt, ofmt, pnm)
+		if os.path.exists(outnm):
+			import shutil
+			shutil.copymode(outnm, tmpnm)
+		os.rename(tmpnm, outnm)
+	except:
+		if os.path.exists(tmpnm):
+			os.unlink(tmpnm)
+		raise
+	flushemails()
+	return nent
+
+def watch(args):
+	"""Keep out in sync with in, or all pairs below DIR (see findpairs()),
+	   until interrupted. Bursts of writes are waited out (until the
+	   files did not change for DEBOUNCE secs) before converting."""
+	import time
+	DEBOUNCE = 0.3
+	watcher = dirwatcher()
+	seen = {}
+	caches = {}
+	first = True
+	if not quiet:
+		print_("Watching %s (%s)" % (' '.join(args), 'inotify' if watcher.fd is not None else 'polling'))
+	try:
+		while True:
+			if len(args) == 1:
+				pairs = findpairs(args[0])
+				for (dirnm, subdirs, files) in os.walk(args[0]):
+					subdirs[:] = [sd for sd in subdirs if sd[0] != '.']
+					watcher.watch(os.path.abspath(dirnm))
+			else:
+				pairs = [tuple(args)]
+				watcher.watch(os.path.abspath(os.path.dirname(args[0]) or '.'))
+			changed = []
+			for (innm, outnm) in pairs:
+				stat = fstat(innm)
+				if stat is None or stat == seen.get(innm):
+					continue
+				seen[innm] = stat
+				# Targets that are newer already are left alone at the start
+				ostat = fstat(outnm)
+				if first and ostat and ostat[0] >= stat[0]:
+					continue
+				changed.append((innm, outnm))
+			first = False
+			# Debounce: Let the writer finish
+			while changed:
+				watcher.wait(DEBOUNCE)
+				now = [(innm, fstat(innm)) for (innm, outnm) in changed]
+				if all(stat == seen[innm] for (innm, stat) in now):
+					break
+				seen.update(now)
+			for (innm, outnm) in changed:
+				start = time.time()
+				try:
+					if entcache:
+						cache = openentrycache()
+					else:
+						cache = caches.setdefault(innm, changelog.memcache())
+					nent = watchconv(innm, outnm, cache)
+				except (changelog.ParseError, ValueError, IOError, OSError) as exc:
+					print_("FAIL %s -> %s: %s" % (innm, outnm, exc))
+					continue
+				if not quiet:
+					print_("OK   %s -> %s (%i entries, %.2fs)" % (innm, outnm, nent, time.time()-start))
+			sys.stdout.flush()
+			watcher.wait()
+	except KeyboardInterrupt:
+		pass
+	watcher.close()
+	return 0
+
+def loademails():
+	"Set up global emails (db) if requested, reuse the daemon's store"
+	global emails
 	if emaildb:
+		if warmemails:
+			db = warmemails
+			db.guess = guessmail
+		else:
+			db = emailsdb(guess = guessmail)
 		if emails:
-			emails = emailsdb(guess = guessmail).addrappend(EMAILDB, emails)
+			emails = db.addrappend(EMAILDB, emails)
 		else:
-			emails = emailsdb(guess = guessmail)
+			emails = db
 
-	chglog = changelog.changelog(pkgnm = pkgnm, distover = dist, initver = initver, emaildb = emails)
-	if infmt == 'rpm':
-		chglog.rpmparse(infd, joinln, tolerant, maxent)
-	elif infmt == 'deb':
-		chglog.debparse(infd, joinln, tolerant, maxent)
-	else:
-		print_("ERROR: Input format %s unknown" % infmt)
-		sys.exit(3)
+class capture(io.StringIO):
+	"Buffer for the output of a daemon request, survives close()"
+	def close(self):
+		pass
 
-	infd.close()
+def handle(conn):
+	"""Daemon child: Read request (JSON line with argv, cwd and optionally
+	   stdin contents), run it like the CLI would and send back a JSON line
+	   with rc, stdout and stderr"""
+	import json
+	import traceback
+	rfd = conn.makefile('rb')
+	req = json.loads(rfd.readline().decode('utf-8'))
+	rfd.close()
+	# Options are per request, not inherited from the daemon's command
+	# line; the warm state (tz index, email store) stays
+	for (nm, val) in OPTDEFAULTS.items():
+		globals()[nm] = copy.copy(val)
+	sys.stdin = io.StringIO(req.get('stdin') or '')
+	sys.stdout = capture()
+	sys.stderr = capture()
+	try:
+		os.chdir(req['cwd'])
+		rc = main(['changelog-transform.py'] + req['argv'])
+	except SystemExit as exc:
+		rc = exc.code
+		if rc is None:
+			rc = 0
+		elif not isinstance(rc, int):
+			print_(rc, file=sys.stderr)
+			rc = 1
+	except Exception:
+		traceback.print_exc()
+		rc = 1
+	resp = {'rc': rc, 'stdout': sys.stdout.getvalue(), 'stderr': sys.stderr.getvalue()}
+	conn.sendall(json.dumps(resp).encode('utf-8') + b'\n')
+	conn.close()
 
-	if outnm == '-':
-		outfd = sys.stdout
-	else:
-		outfd = open(outnm, 'w')
+def serve():
+	"""Daemon: Warm up timezone index and email store, then listen on the
+	   Unix socket socknm and fork a child per request, so requests get
+	   the warm state but can not disturb each other or the daemon"""
+	import socket
+	import errno
+	import signal
+	global warmemails
+	if tzcache:
+		changelog.tzidx.fname = tzcache
+	changelog.tzidx.ensure()
+	if emaildb:
+		loademails()
+		warmemails = emails.preload()
+	sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	if os.path.exists(socknm):
+		try:
+			sock.connect(socknm)
+			print_("ERROR: Daemon already listening on %s" % socknm, file=sys.stderr)
+			return 1
+		except socket.error:
+			os.unlink(socknm)
+		sock.close()
+		sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	oldmask = os.umask(0o077)
+	sock.bind(socknm)
+	os.umask(oldmask)
+	sock.listen(16)
+	sock.settimeout(1.0)
+	signal.signal(signal.SIGTERM, lambda sig, frame: sys.exit(0))
+	if not quiet:
+		print_("Listening on %s" % socknm, file=sys.stderr)
+	try:
+		while True:
+			try:
+				(conn, addr) = sock.accept()
+			except socket.timeout:
+				conn = None
+			if conn:
+				conn.settimeout(None)
+				pid = os.fork()
+				if not pid:
+					sock.close()
+					try:
+						handle(conn)
+					finally:
+						os._exit(0)
+				conn.close()
+			# Reap finished children
+			try:
+				while os.waitpid(-1, os.WNOHANG)[0]:
+					pass
+			except OSError as exc:
+				if exc.errno != errno.ECHILD:
+					raise
+	except (KeyboardInterrupt, SystemExit):
+		pass
+	finally:
+		sock.close()
+		os.unlink(socknm)
+	return 0
 
-	if outfmt == 'rpm':
-		print_(chglog.rpmout(), file=outfd, end='')
-	elif outfmt == 'deb':
-		print_(chglog.debout(), file=outfd, end='')
+def main(argv):
+	args = parse_args(argv)
+	if daemon:
+		return serve()
+	if stats or statsjson:
+		changelog.stats.enabled = True
+		changelog.stats.reset()
+	if profile:
+		import cProfile
+		prof = cProfile.Profile()
+		rc = prof.runcall(run, args)
+		prof.dump_stats(profile)
 	else:
+		rc = run(args)
+	if stats:
+		print_(changelog.stats.textout(), file=sys.stderr, end='')
+	if statsjson:
+		fd = sys.stdout if statsjson == '-' else open(statsjson, 'w')
+		fd.write(changelog.stats.jsonout() + '\n')
+		if fd != sys.stdout:
+			fd.close()
+	return rc
+
+def run(args):
+	"Do the conversion(s) requested by (parsed) args"
+	global infmt, outfmt, pkgnm
+	if tzcache:
+		changelog.tzidx.fname = tzcache
+	if keywords:
+		changelog.textscan.readkeywords(open(keywords, 'r'))
+	if querymode:
+		return query(args)
+	if indexmode:
+		loademails()
+		return indexfiles(args)
+	if batchmode:
+		loademails()
+		if isinstance(emails, emailsdb):
+			emails.preload()
+		return batch(args[0])
+	if watchmode:
+		loademails()
+		return watch(args)
+
+	if combinemode:
+		loademails()
+		try:
+			combine(args[0:-1], args[-1])
+		except (ValueError, IOError, OSError) as exc:
+			print_("ERROR: %s" % exc, file=sys.stderr)
+			sys.exit(2)
+		flushemails()
+		return 0
+
+	innm, outnm = args
+	try:
+		innm = resolveinput(innm, outnm)
+	except (ValueError, IOError, OSError) as exc:
+		print_("ERROR: %s" % exc, file=sys.stderr)
+		sys.exit(2)
+	if not infmt:
+		infmt = guessfmt(innm)
+		if not infmt:
+			print_("ERROR: Can not determine input format", file=sys.stderr)
+			sys.exit(2)
+	if not outfmt:
+		outfmt = guessfmt(outnm)
+		if not outfmt:
+			print_("ERROR: Can not determine output format", file=sys.stderr)
+			sys.exit(2)
+	if not pkgnm:
+		pkgnm = guesspkgnm(innm, outnm, infmt)
+	if infmt not in changelog.FORMATS:
+		print_("ERROR: Input format %s unknown" % infmt)
+		sys.exit(3)
+	if outfmt not in changelog.FORMATS:
 		print_("ERROR: Output format %s unknown" % outfmt)
 		sys.exit(4)
-	
-	outfd.close()
+
+	loademails()
+	if mergemode:
+		if sorted((infmt, outfmt)) != ['deb', 'rpm']:
+			print_("ERROR: Merge needs one RPM and one DEB changelog", file=sys.stderr)
+			sys.exit(2)
+		ndiff = merge(innm, outnm, infmt, outfmt, pkgnm)
+		flushemails()
+		return 1 if ndiff else 0
+	if incr:
+		try:
+			update(innm, outnm, infmt, outfmt, pkgnm)
+		except ValueError as exc:
+			print_("ERROR: Can not update %s: %s" % (outnm, exc), file=sys.stderr)
+			sys.exit(5)
+	else:
+		convert(innm, outnm, infmt, outfmt, pkgnm)
+	flushemails()
 
 	return 0
 
 if __name__ == "__main__":
 	sys.exit(main(sys.argv))
-
@@ -3,48 +3,238 @@
 # Classes to hold RPM .changes and debian.changelog information and to do
 # conversions with them.
 #
-# Ensure that you have a POSIX or en_US.UTF-8 locale when using this.
+# Dates in the standard formats are parsed and formatted without the C
+# library (strptime/strftime), so the locale does not matter for them; oddly
+# formatted dates fall back to strptime and need a POSIX or en_US.UTF-8 locale.
 #
 # (c) Kurt Garloff <kurt@garloff.de>, 1/2018
 # License: CC-BY-SA 3.0
 
-#import os
+import os
 import sys
+import re
+import time
+import functools
+import contextlib
+import threading
 import datetime
 import pytz
 from six import print_
+from six.moves import intern
 
-plineno = 0
+class statistics(threading.local):
+	"""Per-phase timings, counters and cache hit/miss counts for finding
+	   out where a conversion spends its time. Collection is off by
+	   default and switched on for the whole process with enabled.
+	   Code is instrumented with the timed() decorator, phase() and
+	   count()/hit()/miss(), which do nothing while we don't collect.
+	   Phases nest: Time is accounted to the innermost running phase.
+	   Reading line by line can not be told apart from splitting into
+	   entries, it's all accounted to read then (mapiter() separates them).
+	   The data is kept per thread (the instance stats is thread local),
+	   so changelogs parsed in several threads at once don't mix up
+	   their timings; combine them with snapshot()/merge() like the data
+	   from worker processes."""
+	PHASES = ('read', 'split', 'parse', 'date', 'tz', 'email', 'guess', 'wrap', 'output')
+	collect = False
+	def __init__(self):
+		self.reset()
+	@property
+	def enabled(self):
+		return statistics.collect
+	@enabled.setter
+	def enabled(self, val):
+		statistics.collect = val
+	def reset(self):
+		"Clear all data (of this thread), restart wall clock"
+		self.secs = dict.fromkeys(statistics.PHASES, 0.0)
+		self.counts = {}
+		self.stack = []
+		self.last = 0.0
+		self.begin = time.perf_counter()
+	def start(self, phase):
+		"Enter phase (interrupting the running one)"
+		now = time.perf_counter()
+		if self.stack:
+			self.secs[self.stack[-1]] += now - self.last
+		self.stack.append(phase)
+		self.last = now
+	def stop(self, phase):
+		"Leave phase (and phases left open inside it)"
+		now = time.perf_counter()
+		while self.stack:
+			top = self.stack.pop()
+			self.secs[top] += now - self.last
+			self.last = now
+			if top == phase:
+				break
+	@contextlib.contextmanager
+	def timing(self, phase):
+		"Context manager accounting the time spent inside to phase"
+		self.start(phase)
+		try:
+			yield
+		finally:
+			self.stop(phase)
+	def phase(self, phase):
+		"timing(phase) if we collect, a context manager doing nothing otherwise"
+		if not statistics.collect:
+			return NOPHASE
+		return self.timing(phase)
+	def count(self, nm, num = 1):
+		"Increase counter nm (if we collect)"
+		if statistics.collect:
+			self.counts[nm] = self.counts.get(nm, 0) + num
+	def hit(self, cache):
+		self.count(cache + '_hits')
+	def miss(self, cache):
+		self.count(cache + '_misses')
+	def timeiter(self, it, phase):
+		"""Account the time spent in iterator it (outside of nested phases)
+		   to phase. Returns it unchanged if we don't collect."""
+		if not statistics.collect:
+			return it
+		it = iter(it)
+		def timediter():
+			try:
+				while True:
+					with self.timing(phase):
+						try:
+							obj = next(it)
+						except StopIteration:
+							return
+					yield obj
+			finally:
+				if hasattr(it, 'close'):
+					it.close()
+		return timediter()
+	def snapshot(self):
+		"Collected data as dict (e.g. to pass it from a worker process)"
+		return {'secs': dict(self.secs), 'counts': dict(self.counts)}
+	def merge(self, snap):
+		"Add data from snapshot()"
+		for (phase, secs) in snap['secs'].items():
+			self.secs[phase] = self.secs.get(phase, 0.0) + secs
+		for (nm, num) in snap['counts'].items():
+			self.count(nm, num)
+	def report(self):
+		"Timings, counters and cache hit rates as dict"
+		wall = time.perf_counter() - self.begin
+		caches = {}
+		for nm in self.counts:
+			if nm[-5:] == '_hits' or nm[-7:] == '_misses':
+				cache = nm[0:nm.rfind('_')]
+				hits = self.counts.get(cache + '_hits', 0)
+				miss = self.counts.get(cache + '_misses', 0)
+				caches[cache] = {'hits': hits, 'misses': miss,
+						 'rate': float(hits)/(hits+miss)}
+		return {'wall': wall,
+			'phases': dict(self.secs),
+			'other': max(0.0, wall - sum(self.secs.values())),
+			'counts': dict((nm, num) for (nm, num) in self.counts.items()
+					if nm[-5:] != '_hits' and nm[-7:] != '_misses'),
+			'caches': caches}
+	def jsonout(self):
+		"Report as JSON string"
+		import json
+		return json.dumps(self.report(), indent = 1, sort_keys = True)
+	def textout(self):
+		"Report as human readable text"
+		rep = self.report()
+		wall = rep['wall'] or 1e-9
+		strg = '%-12s %10s %6s\n' % ('Phase', 'secs', '%')
+		for phase in statistics.PHASES + tuple(sorted(set(rep['phases']) - set(statistics.PHASES))):
+			secs = rep['phases'].get(phase, 0.0)
+			strg += '%-12s %10.4f %5.1f%%\n' % (phase, secs, 100*secs/wall)
+		strg += '%-12s %10.4f %5.1f%%\n' % ('other', rep['other'], 100*rep['other']/wall)
+		strg += '%-12s %10.4f\n' % ('total', rep['wall'])
+		strg += '%-20s %10s\n' % ('Counter', 'value')
+		for nm in sorted(rep['counts']):
+			strg += '%-20s %10i\n' % (nm, rep['counts'][nm])
+		strg += '%-12s %10s %10s %6s\n' % ('Cache', 'hits', 'misses', 'rate')
+		for nm in sorted(rep['caches']):
+			cache = rep['caches'][nm]
+			strg += '%-12s %10i %10i %5.1f%%\n' % (nm, cache['hits'], cache['misses'], 100*cache['rate'])
+		return strg
+
+class nophase:
+	"Context manager doing nothing (statistics.phase() if we don't collect)"
+	def __enter__(self):
+		return self
+	def __exit__(self, *exc):
+		return False
+
+NOPHASE = nophase()
+
+stats = statistics()
+
+def timed(phase):
+	"""Decorator accounting the time spent in the function to phase
+	   (in stats), costs just a check if we don't collect"""
+	def decorate(func):
+		@functools.wraps(func)
+		def timedfunc(*args, **kwds):
+			if not statistics.collect:
+				return func(*args, **kwds)
+			with stats.timing(phase):
+				return func(*args, **kwds)
+		return timedfunc
+	return decorate
+
+wrapcache = {}
+WRAPCACHEMAX = 8192
 
 def wrap(txt, indent, maxln):
-	"Amazingly complex code to wrap text"
-	strg = ''
+	"Amazingly complex code to wrap text (memoized)"
+	key = (txt, indent, maxln)
+	try:
+		strg = wrapcache[key]
+		stats.hit('wrap')
+		return strg
+	except KeyError:
+		pass
+	stats.miss('wrap')
+	if len(wrapcache) >= WRAPCACHEMAX:
+		wrapcache.clear()
+	strg = wrapcache[key] = dowrap(txt, indent, maxln)
+	return strg
+
+@timed('wrap')
+def dowrap(txt, indent, maxln):
+	"""Wrap text: Keep preformatted (indented) continuation lines, break
+	   at spaces or after hyphens (unless a digit follows), hard break
+	   overlong words. Works on indices into txt and collects the pieces
+	   in a list, so it's linear in the length of txt."""
+	wid = maxln-indent
+	ntxt = len(txt)
+	brk = '\n' + ' '*indent
+	out = []
 	idx = 0
-	while len(txt[idx:]) > maxln-indent:
+	while ntxt-idx > wid:
 		# Handle preformatted text
-		lf   = txt[idx:idx+maxln-indent+1].rfind('\n')
-		if lf > 0 and txt[idx+lf+1] == ' ':
-			strg += txt[idx:idx+lf+1]
-			idx += lf+1
-			strg += ' '*indent
-			while txt[idx] == ' ':
-				idx+=1
+		lf = txt.rfind('\n', idx, idx+wid+1)
+		if lf > idx and lf+1 < ntxt and txt[lf+1] == ' ':
+			out.append(txt[idx:lf+1])
+			out.append(' '*indent)
+			idx = lf+1
+			while idx < ntxt and txt[idx] == ' ':
+				idx += 1
 			continue
 		# Reformatting (wrapping) necessary
-		sep  = txt[idx:idx+maxln-indent].rfind(' ')
-		sep2 = txt[idx:idx+maxln-indent].rfind('-')
-		if sep == -1 and sep2 == -1:
-			strg += txt[idx:idx+maxln-indent] + '\n' + ' '*indent
-			idx += maxln-indent
-		elif sep2 > sep and not txt[sep2+1].isdigit():
-			strg += txt[idx:idx+sep2+1] + '\n' + ' '*indent
-			idx += sep2+1
+		sep  = txt.rfind(' ', idx, idx+wid)
+		sep2 = txt.rfind('-', idx, idx+wid)
+		if sep2 > sep and not txt[sep2+1].isdigit():
+			out.append(txt[idx:sep2+1])
+			idx = sep2+1
+		elif sep != -1:
+			out.append(txt[idx:sep])
+			idx = sep+1
 		else:
-			strg += txt[idx:idx+sep] + '\n' + ' '*indent
-			idx += sep+1
-	strg += txt[idx:]
-	#print_(strg)
-	return strg
+			out.append(txt[idx:idx+wid])
+			idx += wid
+		out.append(brk)
+	out.append(txt[idx:])
+	return ''.join(out)
 
 def mycapwd(txt):
 	"Custom version of capwords()"
@@ -70,36 +260,166 @@ def guessnm(email):
 	return acct + ' ' + doms[0]
 
 
+TZPREF = ['Europe/Amsterdam', 'Europe/Kiev', 'Europe/London', 'Europe/Moscow', 'America/New_York', 'America/Chicago', 'America/Denver', 'America/Los_Angeles', 'America/Sao_Paulo', 'Asia/Seoul', 'Asia/Tokyo', 'Asia/Shanghai', 'Australia/Sydney', 'Africa/Johannesburg']
+
+def iscnmail(email):
+	"Heuristic: Chinese email address?"
+	return bool(email) and email.split('.')[-1] == 'cn'
+
 def tzsearchlist(email):
-	mylist = ['Europe/Amsterdam', 'Europe/Kiev', 'Europe/London', 'Europe/Moscow', 'America/New_York', 'America/Chicago', 'America/Denver', 'America/Los_Angeles', 'America/Sao_Paulo', 'Asia/Seoul', 'Asia/Tokyo', 'Asia/Shanghai', 'Australia/Sydney', 'Africa/Johannesburg']
-	mylist.extend(list(pytz.common_timezones_set)) 
+	mylist = list(TZPREF)
+	mylist.extend(pytz.common_timezones)
 	# CST = China Std Time and Central Std Time
-	if email and email.split('.')[-1] == 'cn':
+	if iscnmail(email):
 		mylist.insert(0, 'Asia/Shanghai')
 	return mylist
 
+class tzindex:
+	"""Index of TZ abbreviations and UTC offsets -> candidate zones.
+	   Built once (lazily) by walking all zones in tzsearchlist() order,
+	   optionally loaded from / saved to a precomputed JSON table.
+	   Lookups are memoized (up to TZCACHEMAX results each, they are
+	   keyed by the exact date, so mostly help when entries get parsed
+	   again, e.g. with -W or -M)."""
+	TZCACHEMAX = 8192
+	def __init__(self, fname = None):
+		self.fname = fname
+		self.bynm = None
+		self.byoff = None
+		self.nmcache = {}
+		self.offcache = {}
+	def build(self):
+		"""Walk all zones once and record the abbrevs and offsets they use.
+		   The tables are only published when complete (threads)."""
+		bynm = {}
+		byoff = {}
+		for tz in tzsearchlist(''):
+			tzi = pytz.timezone(tz)
+			tinfo = getattr(tzi, '_transition_info', None)
+			if not tinfo:
+				tinfo = ((tzi.utcoffset(None), None, tzi.tzname(None)),)
+			for (off, dst, nm) in tinfo:
+				off = int(off.total_seconds())
+				for (idx, key) in ((bynm, nm), (byoff, str(off))):
+					zones = idx.setdefault(key, [])
+					if tz not in zones:
+						zones.append(tz)
+		self.byoff = byoff
+		self.bynm = bynm
+		return self
+	def load(self):
+		"Read precomputed table, returns False if absent or stale"
+		import json
+		try:
+			fd = open(self.fname, 'r')
+			tbl = json.load(fd)
+			fd.close()
+		except (IOError, OSError, ValueError):
+			return False
+		if tbl.get('pytz') != pytz.__version__:
+			return False
+		self.byoff = tbl['offsets']
+		self.bynm = tbl['names']
+		return True
+	def save(self):
+		"Write precomputed table (atomically)"
+		import json
+		tmpnm = '%s.%i' % (self.fname, os.getpid())
+		fd = open(tmpnm, 'w')
+		json.dump({'pytz': pytz.__version__, 'names': self.bynm, 'offsets': self.byoff}, fd)
+		fd.close()
+		os.rename(tmpnm, self.fname)
+	def ensure(self):
+		"Make sure the index is available"
+		if self.bynm is not None:
+			return
+		if self.fname and self.load():
+			return
+		self.build()
+		if self.fname:
+			try:
+				self.save()
+			except (IOError, OSError) as exc:
+				print_("WARN: Can not write tz index %s: %s" % (self.fname, exc), file=sys.stderr)
+	@staticmethod
+	def candidates(zones, email):
+		"Candidate zones, honoring the .cn heuristic"
+		if iscnmail(email):
+			return ['Asia/Shanghai'] + zones
+		return zones
+	@timed('tz')
+	def findnm(self, tznm, date, email = ''):
+		"First zone (in search order) using abbrev tznm at naive date"
+		key = (tznm, date, iscnmail(email))
+		try:
+			tzi = self.nmcache[key]
+			stats.hit('tzname')
+			return tzi
+		except KeyError:
+			pass
+		stats.miss('tzname')
+		self.ensure()
+		tzi = None
+		for tz in tzindex.candidates(self.bynm.get(tznm, []), email):
+			cand = pytz.timezone(tz)
+			try:
+				if cand.tzname(date) == tznm:
+					tzi = cand
+					break
+			except pytz.exceptions.InvalidTimeError:
+				continue
+		if len(self.nmcache) >= tzindex.TZCACHEMAX:
+			self.nmcache.clear()
+		self.nmcache[key] = tzi
+		return tzi
+	@timed('tz')
+	def findoff(self, off, date, email = ''):
+		"First zone (in search order) with UTC offset off at naive date"
+		key = (off, date, iscnmail(email))
+		try:
+			tzi = self.offcache[key]
+			stats.hit('tzoff')
+			return tzi
+		except KeyError:
+			pass
+		stats.miss('tzoff')
+		self.ensure()
+		tzi = None
+		for tz in tzindex.candidates(self.byoff.get(str(int(off.total_seconds())), []), email):
+			cand = pytz.timezone(tz)
+			try:
+				if cand.utcoffset(date) == off:
+					tzi = cand
+					break
+			except pytz.exceptions.InvalidTimeError:
+				continue
+		if len(self.offcache) >= tzindex.TZCACHEMAX:
+			self.offcache.clear()
+		self.offcache[key] = tzi
+		return tzi
+
+tzidx = tzindex()
+
 def findtz(tznm, date, email = ''):
 	"Find timezone by abbreviation, use heuristics"
-	mylist = tzsearchlist(email)
-	for tz in mylist:
-		tzi = pytz.timezone(tz)
-		if tzi.tzname(date) == tznm:
-			return tzi
+	stats.count('tz_lookups')
+	tzi = tzidx.findnm(tznm, date, email)
+	if tzi:
+		return tzi
 	print_("WARNING: Could not parse TZ %s" % tznm, file=sys.stderr)
 	return pytz.utc
 
 def findtzoff(offstr, date, email = ''):
 	"Find timezone by UTC offset, use heuristics"
-	mylist = tzsearchlist(email)
+	stats.count('tz_lookups')
 	sgn = -1 if offstr[0] == '-' else 1
 	off = datetime.timedelta(0, sgn*60*(60*int(offstr[1:3])+int(offstr[3:5])))
 	# Need naive datetime
 	dt = datetime.datetime(date.year, date.month, date.day, date.hour, date.minute, date.second)
-	for tz in mylist:
-		tzi = pytz.timezone(tz)
-		if tzi.utcoffset(dt) == off:
-			return tzi
-	print_("WARNING: Could not parse TZ %s" % tznm, file=sys.stderr)
+	tzi = tzidx.findoff(off, dt, email)
+	if tzi:
+		return tzi
+	print_("WARNING: Could not parse TZ %s" % offstr, file=sys.stderr)
 	return pytz.utc
 
 def increl(prevver):
@@ -113,8 +433,59 @@ def increl(prevver):
 
 class ParseError(ValueError):
 	"Exceptions to throw when we fail to parse RPM/DEB changelog"
-	def __init__(self, errstr, ln = plineno):
-		ValueError.__init__(self, errstr + ' (line ~ %i)' % ln)
+	def __init__(self, errstr, ln = 0, fname = None):
+		if ln and fname:
+			errstr += ' (%s, line %i)' % (fname, ln)
+		elif ln:
+			errstr += ' (line %i)' % ln
+		ValueError.__init__(self, errstr)
+		self.lineno = ln
+		self.fname = fname
+
+class parsecontext:
+	"""Position state of one parse: File name and number of the first line
+	   of the text handed to a parse function. Passed down from changelog
+	   to logentry to logitem parsing instead of keeping global state,
+	   so several changelogs can be parsed at once (e.g. in threads) and
+	   errors carry the right per-file line numbers.
+	   Problems that tolerant parsing worked around are collected in the
+	   list diags (shared with the derived contexts) as (action, message)."""
+	__slots__ = ('fname', 'lineno', 'diags')
+	def __init__(self, fname = None, lineno = 1, diags = None):
+		self.fname = fname
+		self.lineno = lineno
+		self.diags = diags
+	def at(self, offs):
+		"Context for the text starting offs lines further down"
+		return parsecontext(self.fname, self.lineno + offs, self.diags)
+	def error(self, errstr, offs = 0):
+		"ParseError for line offs (0 based) of our text"
+		return ParseError(errstr, self.lineno + offs, self.fname)
+	def problem(self, errstr, offs = 0, tolerant = False, action = 'salvaged'):
+		"""Malformed input at line offs: Raise ParseError or, with
+		   tolerant, record it and return to let the caller do action"""
+		err = self.error(errstr, offs)
+		if not tolerant:
+			raise err
+		self.record(err, action)
+	def record(self, err, action):
+		"Note (and warn about) problem err (exception) worked around by action"
+		stats.count('problems_' + action.split()[0])
+		if self.diags is not None:
+			self.diags.append((action, str(err)))
+		print_("WARN: %s: %s" % (action, err), file=sys.stderr)
+
+def fdname(fd):
+	"File name of fd for error messages (if any)"
+	return getattr(fd, 'name', None)
+
+FORMATS = ('rpm', 'deb', 'json', 'ndjson')
+JSONFMTS = ('json', 'ndjson')
+
+# DEB header: pkg (vers) dist; urgency=urg
+DEBHDRLNRGX = re.compile(r'^(\S+) \(([^()\s]+)\) ([^\s;]+); urgency=(\S+)$')
+# Tolerant DEB header: pkg (vers) dist[;] [urgency=urg] with odd spacing
+DEBHDRSALVRGX = re.compile(r'^(\S+)\s*\(([^)]*)\)\s*([^\s;]+)\s*;?\s*(?:urgency\s*=\s*(\S+))?')
 
 RPMSEP = '-------------------------------------------------------------------'
 RPMHDR = '- '
@@ -124,11 +495,97 @@ DEBHDR = '  * '
 DEBSUB = '    - '
 DEBTMF = '%a, %d %b %Y %H:%M:%S %z'
 
+WDAYS  = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+MONIDX = dict((mon, idx+1) for (idx, mon) in enumerate(MONTHS))
+
+datecache = {}
+DATECACHEMAX = 8192
+
+def cachedate(key, date):
+	"Remember parsed date"
+	if len(datecache) >= DATECACHEMAX:
+		datecache.clear()
+	datecache[key] = date
+	return date
+
+def parsetime(daystr, monstr, yearstr, timestr):
+	"Naive datetime from day, month name, year and HH:MM:SS strings"
+	(hour, mnt, sec) = timestr.split(':')
+	return datetime.datetime(int(yearstr), MONIDX[monstr], int(daystr),
+				 int(hour), int(mnt), int(sec))
+
+@timed('date')
+def parserpmdate(datestr):
+	"""Parse RPM date (RPMTMF, e.g. Tue Jan  2 14:31:12 CET 2018) into
+	   naive datetime, the TZ abbreviation is ignored (see findtz)"""
+	try:
+		date = datecache[datestr]
+		stats.hit('date')
+		return date
+	except KeyError:
+		pass
+	stats.miss('date')
+	try:
+		(wday, mon, day, tm, tznm, year) = datestr.split()
+		if wday not in WDAYS:
+			raise ValueError(wday)
+		date = parsetime(day, mon, year, tm)
+	except (ValueError, KeyError):
+		date = datetime.datetime.strptime(datestr, RPMTMF)
+	return cachedate(datestr, date)
+
+@timed('date')
+def parsedebdate(datestr):
+	"""Parse DEB date (DEBTMF, e.g. Tue,  2 Jan 2018 14:31:12 +0100) into
+	   datetime with fixed offset timezone"""
+	try:
+		date = datecache[datestr]
+		stats.hit('date')
+		return date
+	except KeyError:
+		pass
+	stats.miss('date')
+	try:
+		(wday, day, mon, year, tm, off) = datestr.split()
+		if wday[-1] != ',' or wday[:-1] not in WDAYS or len(off) != 5 or off[0] not in '+-':
+			raise ValueError(wday)
+		mins = 60*int(off[1:3]) + int(off[3:5])
+		if off[0] == '-':
+			mins = -mins
+		date = parsetime(day, mon, year, tm)
+		date = date.replace(tzinfo = datetime.timezone(datetime.timedelta(minutes = mins)))
+	except (ValueError, KeyError):
+		date = datetime.datetime.strptime(datestr, DEBTMF)
+	return cachedate(datestr, date)
+
+def fmtrpmdate(date):
+	"Format aware datetime as RPM date (day space padded)"
+	return '%s %s %2i %02i:%02i:%02i %s %i' % (WDAYS[date.weekday()],
+		MONTHS[date.month-1], date.day, date.hour, date.minute,
+		date.second, date.tzname(), date.year)
+
+def fmtdebdate(date):
+	"Format aware datetime as DEB date (day space padded)"
+	off = date.utcoffset()
+	secs = off.days*86400 + off.seconds
+	if secs % 60:
+		strg = date.strftime(DEBTMF)
+		if strg[5] == '0':
+			strg = strg[0:5]+' '+strg[6:]
+		return strg
+	sgn = '-' if secs < 0 else '+'
+	mins = abs(secs)//60
+	return '%s, %2i %s %i %02i:%02i:%02i %s%02i%02i' % (WDAYS[date.weekday()],
+		date.day, MONTHS[date.month-1], date.year, date.hour,
+		date.minute, date.second, sgn, mins//60, mins%60)
+
 class logitem:
 	"Class to hold one item"
-	def __init__(self, head=None, subitems=[]):
+	__slots__ = ('head', 'subitems')
+	def __init__(self, head=None, subitems=None):
 		self.head = head
-		self.subitems = subitems
+		self.subitems = subitems if subitems is not None else []
 	def genout(self, hdr, sub, lnln):
 		"return generic output string"
 		hln = len(hdr)
@@ -143,16 +600,31 @@ class logitem:
 	def debout(self):
 		"DEB formatted output"
 		return self.genout(DEBHDR, DEBSUB, 70)
-	def genparse(self, txt, hdst, subst, joinln = False, tolerant = False, subcnt = None):
-		"Parse one log item, consisting of head entry and (optionally) subitems"
-		txtln = txt.count('\n')
+	def jsonobj(self):
+		"dict for JSON output"
+		return {'head': self.head, 'subitems': self.subitems}
+	def jsonparse(self, obj):
+		"Fill in from dict obj (see jsonobj())"
+		self.head = obj['head']
+		self.subitems = list(obj.get('subitems') or [])
+		if not isinstance(self.head, str) or not all(isinstance(it, str) for it in self.subitems):
+			raise ValueError('item texts need to be strings')
+		return self
+	def genparse(self, txt, hdst, subst, joinln = False, tolerant = False, subcnt = None, ctx = None):
+		"""Parse one log item, consisting of head entry and (optionally) subitems.
+		   ctx (parsecontext) locates txt for error messages."""
+		if ctx is None:
+			ctx = parsecontext()
 		hdln  = len(hdst)
 		subln = len(subst)
+		stats.count('items')
 		if not subcnt:
 			subcnt = ' '*subln
 		subcln = len(subcnt)
 		if not txt[0:hdln] == hdst:
-			raise ParseError('should start with "%s", got "%s"' % (hdst, txt[0:hdln]), plineno-txtln-2)
+			ctx.problem('should start with "%s", got "%s"' % (hdst, txt[0:hdln]), 0, tolerant)
+			# Take the line as it is (w/o indentation and bullet) as head
+			txt = hdst + txt.lstrip().lstrip('-*+').lstrip()
 		ishead = True
 		self.head = ''
 		self.subitems = []
@@ -173,7 +645,8 @@ class logitem:
 				elif ln[0:hdln] == hdst:
 					self.head += ln[hdln:]
 				else:
-					raise ParseError('unexpected line start "%s"' % ln[0:subln], plineno-txtln-2+lnno)
+					ctx.problem('unexpected line start "%s"' % ln[0:subln], lnno-1, tolerant)
+					self.head += ('\n' + ' '*hdln if not joinln else ' ') + ln.strip()
 			else:
 				if ln[0:subcln] == subcnt:
 					if joinln:
@@ -184,17 +657,18 @@ class logitem:
 					self.subitems.append(sub)
 					sub = ln[subln:]
 				else:
-					raise ParseError('unexpected subitem line start "%s"' % ln[0:subln], plineno-txtln-2+lnno)
+					ctx.problem('unexpected subitem line start "%s"' % ln[0:subln], lnno-1, tolerant)
+					sub += ('\n' + subcnt if not joinln else ' ') + ln.strip()
 		if sub:
 			self.subitems.append(sub)
 		return self
 			
-	def rpmparse(self, txt, joinln = False, tolerant = False):
-		return self.genparse(txt, '- ', '  * ', joinln, tolerant)
-	def debparse(self, txt, joinln = False, tolerant = False):
-		return self.genparse(txt, '  * ', '    - ', joinln, tolerant)
-	def debparse_misssub(self, txt, joinln = False, tolerant = False):
-		return self.genparse(txt, '  * ', '    ', joinln, tolerant, '     ')
+	def rpmparse(self, txt, joinln = False, tolerant = False, ctx = None):
+		return self.genparse(txt, '- ', '  * ', joinln, tolerant, None, ctx)
+	def debparse(self, txt, joinln = False, tolerant = False, ctx = None):
+		return self.genparse(txt, '  * ', '    - ', joinln, tolerant, None, ctx)
+	def debparse_misssub(self, txt, joinln = False, tolerant = False, ctx = None):
+		return self.genparse(txt, '  * ', '    ', joinln, tolerant, '     ', ctx)
 	def contains(self, slist):
 		for strg in slist:
 			if strg in self.head:
@@ -205,6 +679,16 @@ class logitem:
 		return False
 
 
+pkgverrgxs = {}
+
+def pkgverrgx(pkgnm):
+	"Compiled regex to find pkgnm-version (cached per package name)"
+	try:
+		return pkgverrgxs[pkgnm]
+	except KeyError:
+		rgx = pkgverrgxs[pkgnm] = re.compile(r'%s[- ]([0-9]*\.[^ :]*)' % pkgnm)
+		return rgx
+
 class logentry:
 	"Class to hold one changelog entry data"
 	import re
@@ -216,31 +700,31 @@ class logentry:
 	emerkwds = ('emergency',)
 	highkwds = ('CVE', 'exploit')
 	medkwds  = ('security', 'vulnerability', 'leak', 'major', ' critical')
-	def __init__(self, date=None, email=None, authnm=None, pkgnm=None, vers=None, dist='stable', urg='', emaildb = None, items=[]):
+	__slots__ = ('date', 'email', 'authnm', 'pkgnm', 'ver0rgx', 'vers', 'dist', 'urg', 'emaildb', 'items')
+	def __init__(self, date=None, email=None, authnm=None, pkgnm=None, vers=None, dist='stable', urg='', emaildb = None, items=None):
 		self.date = date
 		self.email = email
 		self.authnm = authnm
 		self.pkgnm = pkgnm
-		self.ver0rgx = logentry.re.compile(r'%s[- ]([0-9]*\.[^ :]*)' % pkgnm)
+		self.ver0rgx = pkgverrgx(pkgnm)
 		self.vers = vers
 		self.dist = dist
 		self.urg = urg
 		self.emaildb = emaildb
-		self.items = items
+		self.items = items if items is not None else []
+	@timed('output')
 	def rpmout(self):
 		"Return string with RPM formatted changelog"
-		strg = RPMSEP + '\n'
-		idx = len(strg)
-		strg += self.date.strftime(RPMTMF)
-		if strg[idx+8] == '0':
-			strg = strg[0:idx+8]+' '+strg[idx+9:]
-			#strg[idx+8] = ' '
+		stats.count('entries_out')
+		strg = RPMSEP + '\n' + fmtrpmdate(self.date)
 		strg += " - %s\n\n" % self.email
 		for ent in self.items:
 			strg += ent.rpmout() + '\n'
 		return strg + '\n'
+	@timed('output')
 	def debout(self, prevver = ''):
 		"Return string with DEB formatted changelog"
+		stats.count('entries_out')
 		vers = self.vers
 		if not vers and prevver:
 			vers = increl(prevver)
@@ -249,58 +733,119 @@ class logentry:
 		for ent in self.items:
 			strg += ent.debout() + '\n'
 		strg += '\n -- %s <%s>  ' % (self.authnm, self.email)
-		idx = len(strg)
-		strg += self.date.strftime(DEBTMF)
-		if strg[idx+5] == '0':
-			strg = strg[0:idx+5]+' '+strg[idx+6:]
-			#strg[idx+6] = ' '
-		strg += '\n\n'
+		strg += fmtdebdate(self.date) + '\n\n'
 		return strg
+	def jsonobj(self):
+		"""dict for JSON output: the parsed fields as they are (version
+		   may be None), date in ISO 8601 with the (pytz) zone name if
+		   known, to restore the RPM timezone abbreviation"""
+		obj = {'date': self.date.isoformat(), 'tz': getattr(self.date.tzinfo, 'zone', None),
+		       'email': self.email, 'author': self.authnm, 'package': self.pkgnm,
+		       'version': self.vers, 'distribution': self.dist, 'urgency': self.urg,
+		       'items': [ent.jsonobj() for ent in self.items]}
+		if not obj['tz']:
+			del obj['tz']
+		return obj
+	@timed('output')
+	def jsonout(self):
+		"Return one line JSON object (without newline)"
+		import json
+		stats.count('entries_out')
+		return json.dumps(self.jsonobj(), ensure_ascii = False)
+	def jsonparse(self, obj, ctx = None):
+		"""Fill in from dict obj (see jsonobj()), fields missing there
+		   are set up like for RPM entries: name from emaildb (or guessed),
+		   version and urgency guessed from the text.
+		   ctx (parsecontext) locates obj for error messages"""
+		if ctx is None:
+			ctx = parsecontext()
+		try:
+			self.email = intern(obj['email'])
+			date = datetime.datetime.fromisoformat(obj['date'])
+			if date.tzinfo is None:
+				raise ValueError('date %s without UTC offset' % obj['date'])
+			if obj.get('tz'):
+				date = date.astimezone(pytz.timezone(obj['tz']))
+			self.date = date
+			self.items = [logitem().jsonparse(it) for it in obj['items']]
+			if obj.get('author') and not self.authnm:
+				self.authnm = intern(obj['author'])
+			if obj.get('package'):
+				self.pkgnm = intern(obj['package'])
+				self.ver0rgx = pkgverrgx(self.pkgnm)
+			self.vers = obj.get('version') or None
+			if obj.get('distribution'):
+				self.dist = intern(obj['distribution'])
+			if obj.get('urgency'):
+				self.urg = intern(obj['urgency'])
+		except (KeyError, TypeError, AttributeError, ValueError, pytz.UnknownTimeZoneError) as exc:
+			raise ctx.error('Invalid JSON entry (%s: %s)' % (type(exc).__name__, exc))
+		if not self.authnm:
+			if self.emaildb:
+				self.authnm = self.emaildb[self.email]
+			else:
+				self.authnm = guessnm(self.email)
+		if not self.vers or not self.urg:
+			self.guess(not self.vers, not self.urg)
+		return self
+	def setver(self, vers, ln):
+		"Set version found in ln, derive pkg name if needed"
+		#self.vers = m.group(0)[1:].rstrip('.')
+		self.vers = vers.rstrip('.')
+		if not self.pkgnm:
+			idx = ln.find(self.vers)
+			pidx = ln[0:idx].rfind(' ')
+			self.pkgnm = ln[pidx+1:idx-1]
+			self.ver0rgx = pkgverrgx(self.pkgnm)
+		if self.vers.find('-') == -1:
+			self.vers += '-1'
+	@timed('guess')
+	def guess(self, ver = True, urg = True):
+		"""Guess pkg version and name and/or urgency from changelog text,
+		   in one pass over the items"""
+		for ent in self.items:
+			if ver:
+				vers = textscan.version(ent.head, self.ver0rgx)
+				if vers:
+					self.setver(vers, ent.head)
+					ver = False
+			if urg:
+				lvl = textscan.urgency(ent)
+				if lvl == 'emergency' or lvl == 'high':
+					self.urg = lvl
+					urg = False
+				elif lvl:
+					self.urg = lvl
+			if not ver and not urg:
+				break
+		if urg and not self.urg:
+			self.urg = 'low'
 	def guess_ver_nm(self):
 		"Try to determine pkg version and name from changelog text"
-		for ent in self.items:
-			ln = ent.head
-			m = logentry.verrgx.search(ln)
-			if not m:
-				m = self.ver0rgx.search(ln)
-			if not m:
-				m = logentry.ver1rgx.search(ln)
-			if not m:
-				m = logentry.ver2rgx.search(ln)
-			if not m:
-				m = logentry.ver3rgx.search(ln)
-			if m:
-				#self.vers = m.group(0)[1:].rstrip('.')
-				self.vers = m.group(1).rstrip('.')
-				if not self.pkgnm:
-					idx = ln.find(self.vers)
-					pidx = ln[0:idx].rfind(' ')
-					self.pkgnm = ln[pidx+1:idx-1]
-					self.ver0rgx = logentry.re.compile(r'%s[- ]([0-9]*\.[^ :]*)' % self.pkgnm)
-				if self.vers.find('-') == -1:
-					self.vers += '-1'
-				return
-
-
+		self.guess(True, False)
 	def guess_urg(self):
 		"Guess urgency"
-		for ent in self.items:
-			if ent.contains(logentry.emerkwds):
-				self.urg = 'emergency'
-				return
-			if ent.contains(logentry.highkwds):
-				self.urg = 'high'
-				return
-			if ent.contains(logentry.medkwds):
-				self.urg = 'medium'
-		if not self.urg:
-			self.urg = 'low'
-	def rpmparse(self, txt, joinln = False, tolerant = False):
-		"Parse one RPM changelog entry section"
-		txtln = txt.count('\n')
+		self.guess(False, True)
+	def stamp(self):
+		"Key identifying the entry across formats: (date, lowercase email)"
+		return (self.date, self.email.lower())
+	def samestamp(self, other):
+		"Same entry? (Compares date and email)"
+		return self.stamp() == other.stamp()
+	def text(self):
+		"""Text of all items without any whitespace, to compare entries
+		   across formats and wrapping"""
+		return ''.join(''.join(txt.split()) for ent in self.items
+			       for txt in [ent.head] + ent.subitems)
+	def rpmparse(self, txt, joinln = False, tolerant = False, ctx = None):
+		"""Parse one RPM changelog entry section,
+		   ctx (parsecontext) locates txt for error messages"""
+		if ctx is None:
+			ctx = parsecontext()
 		self.email= ''
 		self.items = []
 		buf = ''
+		bufln = 0
 		procln = 0
 		for ln in txt.splitlines():
 			procln += 1
@@ -315,29 +860,35 @@ class logentry:
 				try:
 					(datestr, email) = ln.split(' - ')
 				except ValueError as exc:
-					raise ParseError('Could not split date - email in "%s"' % ln, plineno-txtln+procln)
-				self.email = email
+					raise ctx.error('Could not split date - email in "%s"' % ln, procln-1)
+				self.email = email = intern(email)
 				tznm = datestr.split(' ')[-2]
-				date = datetime.datetime.strptime(datestr, RPMTMF)
+				date = parserpmdate(datestr)
 				self.date = findtz(tznm, date, email).localize(date)
 				if not self.date:
-					raise ParseError("No such timezone %s" % tznm, plneno-txtln+procln)
+					raise ctx.error("No such timezone %s" % tznm, procln-1)
 				if not self.authnm:
-					if self.emaildb:
-						try:
-							# Need dict-like iface (__getitem__)
-							self.authnm = self.emaildb[email]
-						except KeyError:
+					with stats.phase('email'):
+						if self.emaildb:
+							try:
+								# Need dict-like iface (__getitem__)
+								self.authnm = self.emaildb[email]
+								stats.count('email_lookups')
+							except KeyError:
+								self.authnm = guessnm(email)
+								stats.count('email_lookups')
+								stats.count('names_guessed')
+								print_("WARN: No name found for email %s, guess %s" % (email, self.authnm), file=sys.stderr)
+						else:
 							self.authnm = guessnm(email)
-							print_("WARN: No name found for email %s, guess %s" % (email, self.authnm), file=sys.stderr)
-					else:
-						self.authnm = guessnm(email)
+							stats.count('names_guessed')
+						self.authnm = intern(self.authnm)
 				continue
 			# Handle empty line
 			if not ln:
 				if buf:
 					#print_("EMPTY: " + buf)
-					le = logitem().rpmparse(buf, joinln, tolerant)
+					le = logitem().rpmparse(buf, joinln, tolerant, ctx.at(bufln))
 					self.items.append(le)
 					buf = ''
 					continue
@@ -346,26 +897,29 @@ class logentry:
 			# Handle new log item
 			if ln[0:2] == RPMHDR and buf:
 				#print_("NEW: " + buf)
-				le = logitem().rpmparse(buf, joinln, tolerant)
+				le = logitem().rpmparse(buf, joinln, tolerant, ctx.at(bufln))
 				self.items.append(le)
 				buf = ''
+			if not buf:
+				bufln = procln-1
 			buf += ln + '\n'
 		if buf:
 			#print_("END: "+ buf)
-			le = logitem().rpmparse(buf, joinln, tolerant)
+			le = logitem().rpmparse(buf, joinln, tolerant, ctx.at(bufln))
 			self.items.append(le)
-		if not self.vers:
-			self.guess_ver_nm()
-		if not self.urg:
-			self.guess_urg()
+		if not self.vers or not self.urg:
+			self.guess(not self.vers, not self.urg)
 		return self
 		#return procln
-	def debparse(self, txt, joinln = False, tolerant = False):
-		"Parse one DEB changelog entry section"
-		txtln = txt.count('\n')
+	def debparse(self, txt, joinln = False, tolerant = False, ctx = None):
+		"""Parse one DEB changelog entry section,
+		   ctx (parsecontext) locates txt for error messages"""
+		if ctx is None:
+			ctx = parsecontext()
 		self.urg = ''
 		self.items = []
 		buf = ''
+		bufln = 0
 		procln = 0
 		for ln in txt.splitlines():
 			procln += 1
@@ -373,18 +927,28 @@ class logentry:
 			if ln and ln[0] != ' ':
 				if self.email:
 					break
-			# Handle header
-			if not self.pkgnm:
-				(self.pkgnm, vers, dist, urg) = ln.split(' ')
-				self.vers = vers[1:-1]
-				self.dist = dist[0:-1]
-				self.urg = urg[8:]
+			# Handle header (always the first line)
+			if procln == 1:
+				m = DEBHDRLNRGX.match(ln)
+				if m:
+					(pkgnm, vers, dist, urg) = m.groups()
+				else:
+					m = DEBHDRSALVRGX.match(ln) if tolerant else None
+					if not m:
+						raise ctx.error('Could not split header "%s"' % ln)
+					ctx.problem('Could not split header "%s"' % ln, 0, tolerant)
+					(pkgnm, vers, dist, urg) = m.groups()
+					urg = urg or 'low'
+				self.pkgnm = intern(pkgnm)
+				self.vers = vers
+				self.dist = intern(dist)
+				self.urg = intern(urg)
 				continue
 			# Handle empty line
 			if not ln:
 				if buf:
 					#print_("EMPTY: " + buf)
-					le = logitem().debparse(buf, joinln, tolerant)
+					le = logitem().debparse(buf, joinln, tolerant, ctx.at(bufln))
 					self.items.append(le)
 					buf = ''
 					continue
@@ -393,108 +957,1170 @@ class logentry:
 			# Handle new log item
 			if ln[0:4] == DEBHDR and buf:
 				#print_("NEW: " + buf)
-				le = logitem().debparse(buf, joinln, tolerant)
+				le = logitem().debparse(buf, joinln, tolerant, ctx.at(bufln))
 				self.items.append(le)
 				buf = ''
 			# Handle footer
 			if ln[0:4] == " -- ":
 				idx = ln.find('<')
 				if idx < 0:
-					raise ParseError("No email address in footer %s" % ln, plineno-txtln+procln)
+					raise ctx.error("No email address in footer %s" % ln, procln-1)
 				idx2 = ln.find('>')
-				self.authnm = ln[4:idx-1]
-				self.email = ln[idx+1:idx2]
-				self.date = datetime.datetime.strptime(ln[idx2+3:], DEBTMF)
+				self.authnm = intern(ln[4:idx-1])
+				self.email = intern(ln[idx+1:idx2])
+				self.date = parsedebdate(ln[idx2+3:])
 				tzi = findtzoff(ln[-5:], self.date, self.email)
 				if tzi.zone != 'UTC':
 					self.date = self.date.astimezone(tzi)
 				break
 			# Normal line, process ...
+			if not buf:
+				bufln = procln-1
 			buf += ln + '\n'
 		if buf:
 			#print_("END: "+ buf)
-			le = logitem().debparse(buf, joinln, tolerant)
+			le = logitem().debparse(buf, joinln, tolerant, ctx.at(bufln))
 			self.items.append(le)
+		if not self.email:
+			raise ctx.error('No " -- NAME <EMAIL>  DATE" footer', procln-1)
 		return self
 		#return procln
 
+class textscanner:
+	"""Scanners for urgency keywords and version numbers, used by
+	   logentry.guess(). Keyword tables can be extended.
+	   Note: Plain substring tests and the individual version regexes
+	   (behind a cheap '.' prefilter, all of them need a dot) turned out
+	   to be faster than combined alternations/lookaheads with re."""
+	URGS = ('emergency', 'high', 'medium')
+	def __init__(self):
+		self.kwds = {'emergency': list(logentry.emerkwds),
+			     'high': list(logentry.highkwds),
+			     'medium': list(logentry.medkwds)}
+	def addkeywords(self, urg, kwds):
+		"Add keywords for urgency level urg"
+		if urg not in textscanner.URGS:
+			raise ValueError("Unknown urgency %s" % urg)
+		for kw in kwds:
+			if kw and kw not in self.kwds[urg]:
+				self.kwds[urg].append(kw)
+	def readkeywords(self, fd):
+		"Read \"urgency:keyword\" lines (keyword taken verbatim)"
+		for ln in fd:
+			ln = ln.rstrip('\n')
+			if not ln or ln[0] == '#':
+				continue
+			idx = ln.find(':')
+			if idx < 0:
+				raise ValueError("Invalid keyword line \"%s\"" % ln)
+			self.addkeywords(ln[0:idx].strip(), (ln[idx+1:],))
+	def urgency(self, item):
+		"Highest urgency level of keywords found in item (or None)"
+		for urg in textscanner.URGS:
+			if item.contains(self.kwds[urg]):
+				return urg
+		return None
+	def version(self, ln, ver0rgx):
+		"""Version number found in ln: First match of the first regex that
+		   matches at all (verrgx, ver0rgx, ver1rgx, ver2rgx, ver3rgx)"""
+		if '.' not in ln:
+			return None
+		m = logentry.verrgx.search(ln)
+		if not m:
+			m = ver0rgx.search(ln)
+		if not m:
+			m = logentry.ver1rgx.search(ln)
+		if not m:
+			m = logentry.ver2rgx.search(ln)
+		if not m:
+			m = logentry.ver3rgx.search(ln)
+		if m:
+			return m.group(1)
+		return None
+
+textscan = textscanner()
+
+RPMSEPRGX = re.compile(b'^' + RPMSEP.encode() + b'\r?\n', re.M)
+DEBHDRRGX = re.compile(b'^[^ \r\n]', re.M)
+
+def mapdecode(byts):
+	"Decode bytes like a text mode file would (UTF-8, universal newlines)"
+	txt = byts.decode('utf-8')
+	if '\r' in txt:
+		txt = txt.replace('\r\n', '\n').replace('\r', '\n')
+	return txt
+
+def ismappable(fd):
+	"Can fd be memory mapped? (Non-empty regular file)"
+	import stat
+	try:
+		st = os.fstat(fd.fileno())
+	except (AttributeError, ValueError, OSError):
+		return False
+	return stat.S_ISREG(st.st_mode) and st.st_size > 0
+
+def chunkspans(fd, fmt, nchunks):
+	"""Split mappable file fd in format fmt at entry boundaries into up to
+	   nchunks spans of about equal size, returns list of (start, end, lineno)
+	   as understood by changelog.mapiter()"""
+	import mmap
+	if fmt == 'rpm':
+		rgx = RPMSEPRGX
+	else:
+		rgx = DEBHDRRGX
+	mm = mmap.mmap(fd.fileno(), 0, access = mmap.ACCESS_READ)
+	size = len(mm)
+	spans = []
+	start = 0
+	lno = 1
+	try:
+		for idx in range(1, nchunks):
+			# Next entry start at or after the (byte) target
+			m = rgx.search(mm, max(start+1, size*idx//nchunks))
+			if not m:
+				break
+			pos = m.start()
+			m = None
+			spans.append((start, pos, lno))
+			lno += mm[start:pos].count(b'\n')
+			start = pos
+		spans.append((start, size, lno))
+	finally:
+		m = None
+		mm.close()
+	return spans
+
+def chunkrecv(conn):
+	"Receive object from changelog.chunkconv() worker, reraise its exceptions"
+	obj = conn.recv()
+	if isinstance(obj, Exception):
+		raise obj
+	return obj
+
+class entryinfo:
+	"Version and package name of a logentry (enough for fixupdebver())"
+	__slots__ = ('vers', 'pkgnm')
+	def __init__(self, vers, pkgnm):
+		self.vers = vers
+		self.pkgnm = pkgnm
+
+class entryfilter:
+	"""Window of entries to read from a (newest first) changelog: Those
+	   from since (POSIX timestamp) on and/or those down to and including
+	   the entry that introduced version untilver (the oldest one of the
+	   entries for untilver or untilver-release in a row). The parsers
+	   stop at the first entry outside. The raw text is checked first
+	   (RPM/DEB date, DEB header version), so entries outside only get
+	   parsed if the version needs to be guessed from RPM items.
+	   The version of the entry we stopped at is kept in stopver (if
+	   known), to fill in missing versions of the last ones inside.
+	   For RPM entries it needs to be guessed, see changelog.findstopver(),
+	   which counts the entries without version in unversioned."""
+	__slots__ = ('since', 'untilver', 'seenver', 'stopver', 'unversioned')
+	def __init__(self, since = None, untilver = None):
+		self.since = since
+		self.untilver = untilver
+		self.seenver = False
+		self.stopver = None
+		self.unversioned = None
+	def matchver(self, vers):
+		"Is vers the version we stop after?"
+		return vers == self.untilver or vers[0:len(self.untilver)+1] == self.untilver + '-'
+	def pastver(self, vers):
+		"""Is an entry with version vers (None if unknown) older than the
+		   one that introduced untilver? Notes when we get to untilver."""
+		if vers and self.matchver(vers):
+			self.seenver = True
+			return False
+		return self.seenver
+	@staticmethod
+	def rawdate(txt, fmt):
+		"Date of raw entry text txt in format fmt, None if not found"
+		try:
+			if fmt == 'rpm':
+				ln = txt.split('\n', 2)[1]
+				(datestr, email) = ln.split(' - ')
+				date = parserpmdate(datestr)
+				return findtz(datestr.split(' ')[-2], date, email).localize(date)
+			idx = txt.rfind('\n -- ')
+			if idx < 0:
+				return None
+			ln = txt[idx+1:].split('\n', 1)[0]
+			return parsedebdate(ln[ln.find('>')+3:])
+		except (ValueError, KeyError, IndexError):
+			# Let the full parser complain
+			return None
+	def crossed(self, txt, fmt):
+		"Is raw entry text txt (in format fmt) known to be outside already?"
+		vers = None
+		if fmt == 'deb':
+			hdr = txt.split('\n', 1)[0]
+			vers = hdr[hdr.find('(')+1:hdr.find(')')]
+			if self.untilver and self.pastver(vers):
+				self.stopver = vers
+				return True
+		if self.since is not None:
+			date = self.rawdate(txt, fmt)
+			if date is not None and date.timestamp() < self.since:
+				self.stopver = vers
+				return True
+		return False
+	def reached(self, ent):
+		"Is parsed logentry ent outside?"
+		if self.untilver and self.pastver(ent.vers):
+			# The entry for untilver inside has a version to fill in from
+			self.stopver = ent.vers or ''
+			return True
+		if self.since is not None and ent.date and ent.date.timestamp() < self.since:
+			self.stopver = ent.vers
+			return True
+		return False
+
+def rawstamp(txt, fmt):
+	"""logentry.stamp() of raw entry text txt in format fmt, from its
+	   header (RPM) or footer (DEB) line only, None if that is malformed"""
+	date = entryfilter.rawdate(txt, fmt)
+	if date is None:
+		return None
+	if fmt == 'rpm':
+		email = txt.split('\n', 2)[1].split(' - ')[1]
+	else:
+		ln = txt[txt.rfind('\n -- ')+1:].split('\n', 1)[0]
+		email = ln[ln.find('<')+1:ln.find('>')]
+	return (date, email.lower())
+
+# Item/subitem bullets at line starts, see rawitemtext()
+RAWBULLETRGX = {'rpm': re.compile('^(?:%s|%s)' % (re.escape(RPMHDR), re.escape(RPMSUB)), re.M),
+		'deb': re.compile('^(?:%s|%s)' % (re.escape(DEBHDR), re.escape(DEBSUB)), re.M)}
+
+def rawitemtext(txt, fmt):
+	"""logentry.text() of raw entry text txt in format fmt, without
+	   parsing: The item lines without bullets and whitespace"""
+	if fmt == 'rpm':
+		body = txt.split('\n', 2)[2:]
+	else:
+		body = txt[0:txt.rfind('\n -- ')].split('\n', 1)[1:]
+	if not body:
+		return ''
+	return ''.join(RAWBULLETRGX[fmt].sub('', body[0]).split())
+
 class changelog:
 	"Container for full changelog"
-	def __init__(self, pkgnm=None, authover=None, distover='stable', urgover='', initver = '?-0', emaildb = None, entries=[]):
+	def __init__(self, pkgnm=None, authover=None, distover='stable', urgover='', initver = '?-0', emaildb = None, entries=None, diags=None):
 		self.pkgnm = pkgnm
 		self.authover = authover
 		self.distover = distover
 		self.urgover = urgover
 		self.initver = initver
 		self.emaildb = emaildb
-		self.entries = entries
+		self.entries = entries if entries is not None else []
+		# Problems worked around by tolerant parsing, see parsecontext
+		self.diags = diags if diags is not None else []
 	def rpmout(self):
 		"output RPM changelog as string"
-		strg = ''
-		for ent in self.entries:
-			strg += ent.rpmout()
-		return strg
-	def fixupdebver(self):
+		return ''.join(ent.rpmout() for ent in self.entries)
+	def rpmwrite(self, fd, entries = None):
+		"Write RPM changelog to fd, one entry at a time"
+		if entries is None:
+			entries = self.entries
+		for ent in entries:
+			with stats.phase('output'):
+				fd.write(ent.rpmout())
+	def fixupdebver(self, entries = None):
 		"fill in missing versions by guessing ..."
+		if entries is None:
+			entries = self.entries
 		lastver = self.initver
 		lastpkg = None
-		for idx in range(len(self.entries)-1, -1, -1):
+		for idx in range(len(entries)-1, -1, -1):
 			#print_(sys.stderr, lastver)
-			if not self.entries[idx].vers:
-				self.entries[idx].vers = increl(lastver)
-			if lastpkg and not self.entries[idx].pkgnm:
-				self.entries[idx].pkgnm = lastpkg
+			if not entries[idx].vers:
+				entries[idx].vers = increl(lastver)
+			if lastpkg and not entries[idx].pkgnm:
+				entries[idx].pkgnm = lastpkg
 			elif not lastpkg:
-				lastpkg = self.entries[idx].pkgnm
-			lastver = self.entries[idx].vers
+				lastpkg = entries[idx].pkgnm
+			lastver = entries[idx].vers
+	def fixupdebveriter(self, entries):
+		"""fixupdebver() for a newest-first stream of entries.
+		   Versions are backfilled from older to newer entries, so entries
+		   without version are held back until the next (older) entry
+		   with a version shows up. Entries without package name need the
+		   oldest known name and are held back until the end."""
+		pend = []
+		nopkg = False
+		for ent in entries:
+			pend.append(ent)
+			if not ent.pkgnm:
+				nopkg = True
+			if ent.vers and not nopkg:
+				self.fixupdebver(pend)
+				for pent in pend:
+					yield pent
+				pend = []
+		self.fixupdebver(pend)
+		for pent in pend:
+			yield pent
 	def debout(self):
 		"output DEB changelog as string"
 		self.fixupdebver()
-		strg = ''
-		for ent in self.entries:
-			strg += ent.debout()
-		return strg
+		return ''.join(ent.debout() for ent in self.entries)
+	def debwrite(self, fd, entries = None):
+		"Write DEB changelog to fd, one entry at a time"
+		if entries is None:
+			self.fixupdebver()
+			entries = self.entries
+		else:
+			entries = self.fixupdebveriter(entries)
+		for ent in entries:
+			with stats.phase('output'):
+				fd.write(ent.debout())
+	def jsonwrite(self, fd, entries = None, nd = False):
+		"""Write changelog to fd as JSON array of entry objects (one per
+		   line) or with nd as NDJSON (one object per line, no array),
+		   one entry at a time"""
+		if entries is None:
+			entries = self.entries
+		sep = '[\n' if not nd else ''
+		for ent in entries:
+			with stats.phase('output'):
+				fd.write(sep + ent.jsonout())
+			sep = ',\n' if not nd else '\n'
+		if not nd:
+			fd.write('[\n]\n' if sep == '[\n' else '\n]\n')
+		elif sep:
+			fd.write('\n')
+	def write(self, fd, fmt, entries = None):
+		"Write changelog to fd in format fmt (one of FORMATS)"
+		if fmt == 'rpm':
+			self.rpmwrite(fd, entries)
+		elif fmt == 'deb':
+			self.debwrite(fd, entries)
+		elif fmt in JSONFMTS:
+			self.jsonwrite(fd, entries, fmt == 'ndjson')
+		else:
+			raise ValueError('Unknown changelog format %s' % fmt)
+
+	def newerthan(self, entries, last):
+		"""Collect entries up to (excluding) the one matching last
+		   (by date and email) and stop consuming the entries there.
+		   Raises ValueError if last is never reached."""
+		for ent in entries:
+			if ent.samestamp(last):
+				return self
+			self.entries.append(ent)
+		raise ValueError("Entry %s - %s not found" % (last.date, last.email))
 
-	def rpmparse(self, fd, joinln = False, tolerant = False, maxent = 0):
-		"Parse full RPM changelog"
-		global plineno
+	def newentry(self):
+		"Create empty logentry with our defaults"
+		return logentry(authnm = self.authover, pkgnm = self.pkgnm, dist = self.distover, urg = self.urgover, emaildb = self.emaildb)
+	def parseentry(self, txt, fmt, joinln = False, tolerant = False, ctx = None, filt = None):
+		"""Parse text of one entry in format fmt, located by ctx (parsecontext).
+		   Returns None if the entry is outside entryfilter filt, its version
+		   (if known) then becomes initver. With tolerant, problems in items
+		   are worked around and entries that can't be salvaged are skipped
+		   (returning False), see diags."""
+		if ctx is None:
+			ctx = parsecontext(None, 1, self.diags)
+		if filt and filt.unversioned is not None:
+			return self.findstopver(txt, filt)
+		if filt and filt.crossed(txt, fmt):
+			if filt.stopver is None and fmt == 'rpm':
+				filt.unversioned = 0
+				return self.findstopver(txt, filt)
+			if filt.stopver:
+				self.initver = filt.stopver
+			return None
+		stats.count('entries')
+		try:
+			with stats.phase('parse'):
+				if fmt == 'rpm':
+					ent = self.newentry().rpmparse(txt, joinln, tolerant, ctx)
+				else:
+					ent = logentry(authnm = self.authover, pkgnm = self.pkgnm, dist = self.distover, urg = self.urgover).debparse(txt, joinln, tolerant, ctx)
+		except (ValueError, KeyError, IndexError) as exc:
+			if not tolerant:
+				raise
+			ctx.record(exc if isinstance(exc, ParseError) else ctx.error(str(exc)), 'skipped entry')
+			return False
+		if filt and filt.reached(ent):
+			if filt.stopver is None and fmt == 'rpm':
+				filt.unversioned = 1
+				return False
+			if filt.stopver:
+				self.initver = filt.stopver
+			return None
+		return ent
+	def rawversion(self, txt):
+		"""Version of the raw RPM entry text txt, guessed from the first
+		   lines of its items like logentry.guess() does (without parsing)"""
+		ent = self.newentry()
+		ent.items = [logitem(ln[len(RPMHDR):]) for ln in txt.split('\n')
+			     if ln[0:len(RPMHDR)] == RPMHDR]
+		ent.guess(True, False)
+		return ent.vers
+	def findstopver(self, txt, filt):
+		"""The RPM entries past entryfilter filt have no version: Guess it
+		   from raw entry text txt (the next one) to get the one a full
+		   conversion would backfill for the first entry outside. Returns
+		   None (stop) once found, False (skip) while we need to go on."""
+		vers = self.rawversion(txt)
+		if not vers:
+			filt.unversioned += 1
+			return False
+		for num in range(filt.unversioned):
+			vers = increl(vers)
+		filt.stopver = self.initver = vers
+		filt.unversioned = None
+		return None
+	def jsonentry(self, obj, ctx = None):
+		"Entry from decoded JSON object obj, located by ctx (parsecontext)"
+		if ctx is None:
+			ctx = parsecontext(None, 1, self.diags)
+		stats.count('entries')
+		if not isinstance(obj, dict):
+			raise ctx.error('JSON entry is no object')
+		with stats.phase('parse'):
+			return self.newentry().jsonparse(obj, ctx)
+
+	def rpmiter(self, fd, joinln = False, tolerant = False, maxent = 0, filt = None):
+		"""Generator: Parse RPM changelog from fd, yield one logentry at a time,
+		   stop at the first one outside entryfilter filt (if given)"""
+		ctx = parsecontext(fdname(fd), 1, self.diags)
 		buf = ''
+		bufln = 1
+		lno = 0
 		ent = 0
 		for ln in fd:
-			plineno += 1
+			lno += 1
 			if ln == RPMSEP+'\n':
 				if buf:
 					#print_(buf)
-					self.entries.append(logentry(authnm = self.authover, pkgnm = self.pkgnm, dist = self.distover, urg = self.urgover, emaildb = self.emaildb).rpmparse(buf, joinln, tolerant))
+					entry = self.parseentry(buf, 'rpm', joinln, tolerant, ctx.at(bufln-1), filt)
+					if entry is None:
+						return
+					if entry:
+						yield entry
 					buf = ''
 				ent += 1
 				if maxent and ent > maxent:
 					break
+			if not buf:
+				bufln = lno
 			buf += ln
 		if buf:
 			#print_(buf)
-			self.entries.append(logentry(authnm = self.authover, pkgnm = self.pkgnm, dist = self.distover, urg = self.urgover, emaildb = self.emaildb).rpmparse(buf, joinln, tolerant))
+			entry = self.parseentry(buf, 'rpm', joinln, tolerant, ctx.at(bufln-1), filt)
+			if entry is None:
+				return
+			if entry:
+				yield entry
+
+	def rpmparse(self, fd, joinln = False, tolerant = False, maxent = 0, filt = None):
+		"Parse full RPM changelog (or the entries in entryfilter filt)"
+		self.entries.extend(stats.timeiter(self.rpmiter(fd, joinln, tolerant, maxent, filt), 'read'))
 		return self
 
-	def debparse(self, fd, joinln = False, tolerant = False, maxent = 0):
-		"Parse full DEB changelog"
-		global plineno
+	def debiter(self, fd, joinln = False, tolerant = False, maxent = 0, filt = None):
+		"""Generator: Parse DEB changelog from fd, yield one logentry at a time,
+		   stop at the first one outside entryfilter filt (if given)"""
+		ctx = parsecontext(fdname(fd), 1, self.diags)
 		buf = ''
+		bufln = 1
+		lno = 0
 		ent = 0
 		for ln in fd:
-			plineno += 1
+			lno += 1
 			if ln != '\n' and ln[0] != ' ':
 				if buf:
 					#print_(buf)
-					self.entries.append(logentry(authnm = self.authover, pkgnm = self.pkgnm, dist = self.distover, urg = self.urgover).debparse(buf, joinln, tolerant))
+					entry = self.parseentry(buf, 'deb', joinln, tolerant, ctx.at(bufln-1), filt)
+					if entry is None:
+						return
+					if entry:
+						yield entry
 					buf = ''
 				ent += 1
 				if maxent and ent > maxent:
 					break
+			if not buf:
+				bufln = lno
 			buf += ln
 		if buf:
 			#print_(buf)
-			self.entries.append(logentry(authnm = self.authover, pkgnm = self.pkgnm, dist = self.distover, urg = self.urgover).debparse(buf, joinln, tolerant))
+			entry = self.parseentry(buf, 'deb', joinln, tolerant, ctx.at(bufln-1), filt)
+			if entry is None:
+				return
+			if entry:
+				yield entry
+
+	def mapiter(self, fd, fmt = 'rpm', joinln = False, tolerant = False, maxent = 0, span = None, filt = None):
+		"""Generator: Parse changelog from a regular file fd by memory
+		   mapping it. Entry boundaries are located with a regex search
+		   on the mapped bytes, and only the text of one entry at a time
+		   is copied out and decoded. Yields the same entries as
+		   rpmiter()/debiter().
+		   span = (start, end, lineno) restricts parsing to the bytes
+		   start ... end-1 (starting at an entry boundary, in line lineno),
+		   see chunkspans(). filt: see rpmiter().
+		   Wrap it in stats.timeiter(..., 'split') for statistics."""
+		import mmap
+		if fmt == 'rpm':
+			rgx = RPMSEPRGX
+		else:
+			rgx = DEBHDRRGX
+		mm = mmap.mmap(fd.fileno(), 0, access = mmap.ACCESS_READ)
+		ctx = parsecontext(fdname(fd), 1, self.diags)
+		if span:
+			(start, end, lno) = span
+			lno -= 1
+		else:
+			(start, end, lno) = (0, len(mm), 0)
+		ent = 0
+		it = rgx.finditer(mm, start, end)
+		try:
+			for m in it:
+				pos = m.start()
+				if pos > start:
+					with stats.phase('read'):
+						txt = mapdecode(mm[start:pos])
+					entry = self.parseentry(txt, fmt, joinln, tolerant, ctx.at(lno), filt)
+					if entry is None:
+						return
+					if entry:
+						yield entry
+					lno += txt.count('\n')
+					start = pos
+				ent += 1
+				if maxent and ent > maxent:
+					return
+			if end > start:
+				with stats.phase('read'):
+					txt = mapdecode(mm[start:end])
+				entry = self.parseentry(txt, fmt, joinln, tolerant, ctx.at(lno), filt)
+				if entry is None:
+					return
+				if entry:
+					yield entry
+		finally:
+			# Release buffer exports before unmapping
+			it = None
+			m = None
+			mm.close()
+
+	def jsoniter(self, fd, maxent = 0, filt = None):
+		"""Generator: Read JSON or NDJSON changelog (see jsonwrite()) from
+		   text stream fd, yield one logentry at a time. NDJSON is read
+		   line by line, a JSON array needs to be loaded completely.
+		   Stops at the first entry outside entryfilter filt (if given)."""
+		import json
+		ctx = parsecontext(fdname(fd), 1, self.diags)
+		lno = 0
+		ln = ''
+		for ln in fd:
+			lno += 1
+			if ln.strip():
+				break
+		if ln.lstrip()[0:1] == '[':
+			try:
+				objs = json.loads(ln + fd.read())
+			except ValueError as exc:
+				raise ctx.error('Invalid JSON: %s' % exc)
+			if not isinstance(objs, list):
+				raise ctx.error('JSON changelog needs to be an array of entries')
+			for (idx, obj) in enumerate(objs[0:maxent] if maxent else objs):
+				# Right for jsonwrite() output with one entry per line
+				entry = self.jsonentry(obj, ctx.at(lno + idx))
+				if filt and filt.reached(entry):
+					return
+				yield entry
+			return
+		ent = 0
+		while ln:
+			if ln.strip():
+				try:
+					obj = json.loads(ln)
+				except ValueError as exc:
+					raise ctx.error('Invalid JSON: %s' % exc, lno-1)
+				entry = self.jsonentry(obj, ctx.at(lno-1))
+				if filt and filt.reached(entry):
+					return
+				yield entry
+				ent += 1
+				if maxent and ent >= maxent:
+					return
+			ln = fd.readline()
+			lno += 1
+
+	def debparse(self, fd, joinln = False, tolerant = False, maxent = 0, filt = None):
+		"Parse full DEB changelog (or the entries in entryfilter filt)"
+		self.entries.extend(stats.timeiter(self.debiter(fd, joinln, tolerant, maxent, filt), 'read'))
 		return self
 
+	def chunkconv(self, conn, infd, infmt, outfmt, span, joinln, tolerant):
+		"""Worker for parconvert(): Parse the entries in span, render them
+		   and send the output back over conn (a multiprocessing Pipe end).
+		   For DEB output, (vers, pkgnm) of the entries are sent first and
+		   the fixed up values are expected back before rendering.
+		   Exceptions are sent back instead."""
+		try:
+			stats.reset()
+			ents = list(stats.timeiter(self.mapiter(infd, infmt, joinln, tolerant, 0, span), 'split'))
+			if outfmt == 'deb':
+				conn.send([(ent.vers, ent.pkgnm) for ent in ents])
+				for (ent, (vers, pkgnm)) in zip(ents, conn.recv()):
+					ent.vers = vers
+					ent.pkgnm = pkgnm
+				out = ''.join(ent.debout() for ent in ents)
+			else:
+				out = ''.join(ent.rpmout() for ent in ents)
+			# e.g. emailsdb: Write back what we learned
+			flush = getattr(self.emaildb, 'flush', None)
+			if flush:
+				flush()
+			conn.send((out, len(ents), stats.snapshot() if stats.enabled else None, self.diags))
+		except Exception as exc:
+			conn.send(exc)
+		conn.close()
+
+	def parconvert(self, infd, infmt, outfd, outfmt, joinln = False, tolerant = False, nproc = 2):
+		"""Convert changelog from regular file infd (format infmt) to outfd
+		   (format outfmt) in nproc processes, each parsing and rendering
+		   one chunk of entries (see chunkspans()). The only sequential
+		   step is fixupdebver() for DEB output, which runs here on the
+		   versions and package names collected from the workers.
+		   Output is identical to rpmparse()/debparse() + rpmwrite()/debwrite().
+		   Returns the number of entries."""
+		import multiprocessing
+		mpctx = multiprocessing.get_context('fork')
+		# Warm up shared state before forking workers
+		tzidx.ensure()
+		spans = chunkspans(infd, infmt, nproc)
+		workers = []
+		ok = False
+		try:
+			for span in spans:
+				(conn, wconn) = mpctx.Pipe()
+				proc = mpctx.Process(target = self.chunkconv,
+						     args = (wconn, infd, infmt, outfmt, span, joinln, tolerant))
+				proc.start()
+				wconn.close()
+				workers.append((proc, conn))
+			if outfmt == 'deb':
+				infos = []
+				lens = []
+				for (proc, conn) in workers:
+					vers = chunkrecv(conn)
+					infos.extend(entryinfo(ver, pkgnm) for (ver, pkgnm) in vers)
+					lens.append(len(vers))
+				self.fixupdebver(infos)
+				idx = 0
+				for ((proc, conn), num) in zip(workers, lens):
+					conn.send([(info.vers, info.pkgnm) for info in infos[idx:idx+num]])
+					idx += num
+			nent = 0
+			for (proc, conn) in workers:
+				(out, num, snap, diags) = chunkrecv(conn)
+				self.diags.extend(diags)
+				with stats.phase('output'):
+					outfd.write(out)
+				if snap:
+					stats.merge(snap)
+				nent += num
+			ok = True
+		finally:
+			for (proc, conn) in workers:
+				conn.close()
+				if not ok:
+					proc.terminate()
+				proc.join()
+		return nent
 
+def pairentries(astamps, bstamps):
+	"""Match the entries of two (newest first) changelogs by their
+	   stamps (lists of logentry.stamp() values, e.g. from
+	   lazychangelog.stamp()), using hash maps. Entries sharing a stamp
+	   on one side are matched by occurrence (the n-th with the n-th on
+	   the other side). Returns the union as list of (aidx, bidx) in
+	   newest first order, with None for the index on the side that
+	   lacks the entry. Linear in the number of entries."""
+	maps = ({}, {})
+	keys = ([], [])
+	for (side, stamps) in enumerate((astamps, bstamps)):
+		seen = {}
+		for (idx, stmp) in enumerate(stamps):
+			num = seen.get(stmp, 0)
+			seen[stmp] = num + 1
+			keys[side].append((stmp, num))
+			maps[side][(stmp, num)] = idx
+	(amap, bmap) = maps
+	(akeys, bkeys) = keys
+	pairs = []
+	done = set()
+	aidx = 0
+	bidx = 0
+	while True:
+		while aidx < len(akeys) and akeys[aidx] in done:
+			aidx += 1
+		while bidx < len(bkeys) and bkeys[bidx] in done:
+			bidx += 1
+		if aidx >= len(akeys) and bidx >= len(bkeys):
+			break
+		if aidx >= len(akeys):
+			key = bkeys[bidx]
+		elif bidx >= len(bkeys):
+			key = akeys[aidx]
+		elif akeys[aidx] == bkeys[bidx] or akeys[aidx][0] >= bkeys[bidx][0]:
+			key = akeys[aidx]
+		else:
+			key = bkeys[bidx]
+		pairs.append((amap.get(key), bmap.get(key)))
+		done.add(key)
+	return pairs
+
+def mergeentries(streams):
+	"""Generator: k-way merge of newest first entry streams (iterables of
+	   logentry, e.g. from mapiter()/rpmiter()/debiter()) into one newest
+	   first stream, with a heap over the streams' next entries (stable:
+	   for equal dates, earlier streams come first). Only those next
+	   entries are held in memory. Entries equal to an earlier one (date,
+	   email and text ignoring whitespace, see stamp() and text()) are
+	   dropped; as they share the date, only the keys of the current date
+	   need to be remembered."""
+	import heapq
+	date = None
+	seen = set()
+	for ent in heapq.merge(*streams, key = lambda ent: ent.date, reverse = True):
+		if ent.date != date:
+			date = ent.date
+			seen = set()
+		key = (ent.stamp(), ent.text())
+		if key in seen:
+			stats.count('duplicates')
+			continue
+		seen.add(key)
+		yield ent
+
+class entrycache:
+	"""On-disk cache of rendered entries (sqlite file fname), keyed by a
+	   hash of the raw entry text and the conversion options, limited to
+	   about maxsize bytes of output by evicting least recently used ones.
+	   For DEB output, the header line depends on the neighbour entries
+	   (fixupdebver()), so the entry's own version, package name,
+	   distribution and urgency are stored instead of it.
+	   New entries and access times are only written by flush()."""
+	ATIMEGRAN = 3600
+	def __init__(self, fname, maxsize = 64<<20):
+		self.fname = fname
+		self.maxsize = maxsize
+		self.pid = None
+		self.conn = None
+		self.new = {}
+		self.used = set()
+	def connect(self):
+		"(Re)connect to the database, e.g. after a fork, create if needed"
+		import sqlite3
+		if self.conn and self.pid == os.getpid():
+			return self.conn
+		self.pid = os.getpid()
+		self.conn = sqlite3.connect(self.fname, timeout=60, isolation_level=None)
+		self.conn.execute('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, '
+				  'out TEXT NOT NULL, vers TEXT, pkgnm TEXT, dist TEXT, urg TEXT, '
+				  'size INTEGER NOT NULL, atime REAL NOT NULL)')
+		self.conn.execute('CREATE INDEX IF NOT EXISTS entries_atime ON entries (atime)')
+		return self.conn
+	@staticmethod
+	def key(opts, txt):
+		"Cache key for raw entry text txt converted with options string opts"
+		import hashlib
+		return hashlib.sha1((opts + '\0' + txt).encode('utf-8')).hexdigest()
+	def get(self, key):
+		"(out, vers, pkgnm, dist, urg) stored for key or None"
+		try:
+			row = self.new[key]
+		except KeyError:
+			row = self.connect().execute('SELECT out, vers, pkgnm, dist, urg, atime FROM entries WHERE key=?', (key,)).fetchone()
+		if row is None:
+			stats.miss('entrycache')
+			return None
+		stats.hit('entrycache')
+		# LRU does not need exact times, save most of the updates
+		if len(row) > 5 and row[5] < time.time() - entrycache.ATIMEGRAN:
+			self.used.add(key)
+		return tuple(row[0:5])
+	def put(self, key, out, vers = None, pkgnm = None, dist = None, urg = None):
+		"Remember rendered entry"
+		self.new[key] = (out, vers, pkgnm, dist, urg)
+	def flush(self):
+		"Store new entries, update access times, evict old entries"
+		if not self.new and not self.used:
+			return self
+		now = time.time()
+		cur = self.connect().cursor()
+		cur.execute('BEGIN IMMEDIATE')
+		cur.executemany('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+				((key,) + row + (len(row[0]), now) for (key, row) in self.new.items()))
+		cur.executemany('UPDATE entries SET atime=? WHERE key=?',
+				((now, key) for key in self.used if key not in self.new))
+		self.evict(cur)
+		cur.execute('COMMIT')
+		self.new = {}
+		self.used = set()
+		return self
+	def evict(self, cur):
+		"Remove least recently used entries beyond maxsize"
+		size = cur.execute('SELECT SUM(size) FROM entries').fetchone()[0] or 0
+		if size <= self.maxsize:
+			return
+		old = []
+		for (key, esize) in cur.execute('SELECT key, size FROM entries ORDER BY atime').fetchall():
+			if size <= self.maxsize:
+				break
+			old.append((key,))
+			size -= esize
+		cur.executemany('DELETE FROM entries WHERE key=?', old)
+
+class memcache:
+	"""In-memory stand-in for entrycache for repeated conversions of the
+	   same (changing) file: Keeps the entries used since the previous
+	   flush(), so only new or edited entries get parsed and rendered."""
+	def __init__(self):
+		self.old = {}
+		self.cur = {}
+	def get(self, key):
+		"(out, vers, pkgnm, dist, urg) stored for key or None"
+		row = self.cur.get(key) or self.old.get(key)
+		if row is None:
+			stats.miss('memcache')
+			return None
+		stats.hit('memcache')
+		self.cur[key] = row
+		return row
+	def put(self, key, out, vers = None, pkgnm = None, dist = None, urg = None):
+		"Remember rendered entry"
+		self.cur[key] = (out, vers, pkgnm, dist, urg)
+	def flush(self):
+		"Forget the entries not used since the last flush()"
+		self.old = self.cur
+		self.cur = {}
+		return self
+
+class entryindex:
+	"""Searchable on-disk index (sqlite file fname) of the entries of many
+	   changelogs: package, version, date, email, author, urgency and item
+	   text, the latter full-text indexed (FTS5 if sqlite has it, else
+	   matched with LIKE). Files are only reindexed if their size and mtime
+	   and then their content hash changed."""
+	def __init__(self, fname):
+		self.fname = fname
+		self.pid = None
+		self.conn = None
+		self.fts = False
+	def connect(self):
+		"(Re)connect to the database, e.g. after a fork, create if needed"
+		import sqlite3
+		if self.conn and self.pid == os.getpid():
+			return self.conn
+		self.pid = os.getpid()
+		self.conn = sqlite3.connect(self.fname, timeout=60, isolation_level=None)
+		cur = self.conn.cursor()
+		cur.execute('BEGIN IMMEDIATE')
+		cur.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, '
+			    'mtime REAL NOT NULL, size INTEGER NOT NULL, hash TEXT NOT NULL, fmt TEXT)')
+		cur.execute('CREATE TABLE IF NOT EXISTS entries (id INTEGER PRIMARY KEY, '
+			    'path TEXT NOT NULL, pos INTEGER NOT NULL, pkgnm TEXT, vers TEXT, '
+			    'date REAL, datestr TEXT, email TEXT, authnm TEXT, urg TEXT, dist TEXT, text TEXT)')
+		for col in ('path', 'pkgnm', 'date', 'email'):
+			cur.execute('CREATE INDEX IF NOT EXISTS entries_%s ON entries (%s)' % (col, col))
+		try:
+			cur.execute("CREATE VIRTUAL TABLE IF NOT EXISTS entrytext USING fts5"
+				    "(text, content='entries', content_rowid='id')")
+			cur.execute("CREATE TRIGGER IF NOT EXISTS entries_ins AFTER INSERT ON entries BEGIN "
+				    "INSERT INTO entrytext(rowid, text) VALUES (new.id, new.text); END")
+			cur.execute("CREATE TRIGGER IF NOT EXISTS entries_del AFTER DELETE ON entries BEGIN "
+				    "INSERT INTO entrytext(entrytext, rowid, text) VALUES ('delete', old.id, old.text); END")
+			self.fts = True
+		except sqlite3.OperationalError:
+			self.fts = False
+		cur.execute('COMMIT')
+		return self.conn
+	@staticmethod
+	def filehash(fd):
+		"sha1 of the (binary) stream fd"
+		import hashlib
+		hsh = hashlib.sha1()
+		for blk in iter(lambda: fd.read(1<<20), b''):
+			hsh.update(blk)
+		return hsh.hexdigest()
+	def known(self, path, mtime, size):
+		"Known hash of file path if its mtime and size did not change, else None"
+		row = self.connect().execute('SELECT mtime, size, hash FROM files WHERE path=?', (path,)).fetchone()
+		if row and row[0] == mtime and row[1] == size:
+			return row[2]
+		return None
+	def samehash(self, path, mtime, size, hsh):
+		"Record new mtime and size if file path's content is unchanged, return whether it is"
+		cur = self.connect().cursor()
+		cur.execute('BEGIN IMMEDIATE')
+		cur.execute('UPDATE files SET mtime=?, size=? WHERE path=? AND hash=?', (mtime, size, path, hsh))
+		same = cur.rowcount > 0
+		cur.execute('COMMIT')
+		return same
+	@staticmethod
+	def row(ent):
+		"Index columns for logentry ent (without path and position)"
+		if ent.date is None:
+			date = None
+			datestr = None
+		else:
+			date = ent.date.timestamp()
+			datestr = ent.date.isoformat()
+		text = '\n'.join(txt for it in ent.items for txt in [it.head] + it.subitems)
+		return (ent.pkgnm, ent.vers, date, datestr, ent.email, ent.authnm, ent.urg, ent.dist, text)
+	def store(self, path, mtime, size, hsh, fmt, entries):
+		"""(Re)place the entries of file path. RPM entries are expected
+		   to have their version and urgency guessed already."""
+		cur = self.connect().cursor()
+		cur.execute('BEGIN IMMEDIATE')
+		try:
+			cur.execute('DELETE FROM entries WHERE path=?', (path,))
+			cur.executemany('INSERT INTO entries (path, pos, pkgnm, vers, date, datestr, email, authnm, urg, dist, text) '
+					'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+					((path, pos) + self.row(ent) for (pos, ent) in enumerate(entries)))
+			cur.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)', (path, mtime, size, hsh, fmt))
+		except:
+			cur.execute('ROLLBACK')
+			raise
+		cur.execute('COMMIT')
+		return cur.rowcount
+	def files(self, prefix = ''):
+		"Indexed file paths starting with prefix"
+		return [row[0] for row in self.connect().execute(
+			"SELECT path FROM files WHERE substr(path, 1, ?)=?", (len(prefix), prefix))]
+	def remove(self, paths):
+		"Drop files paths and their entries from the index"
+		cur = self.connect().cursor()
+		cur.execute('BEGIN IMMEDIATE')
+		for path in paths:
+			cur.execute('DELETE FROM entries WHERE path=?', (path,))
+			cur.execute('DELETE FROM files WHERE path=?', (path,))
+		cur.execute('COMMIT')
+	def query(self, words = (), pkgnm = None, author = None, vers = None, urg = None,
+		  since = None, until = None, limit = 0):
+		"""Matching entries, newest first, as (path, pos, pkgnm, vers,
+		   datestr, email, authnm, urg, text) tuples. words must all occur
+		   in the text (as FTS5 phrases: case and punctuation are ignored
+		   with FTS5, LIKE only ignores ASCII case), author matches name
+		   or email substrings, vers also matches its -release variants,
+		   since/until are POSIX timestamps (inclusive/exclusive)."""
+		conn = self.connect()
+		conds = []
+		args = []
+		if words and self.fts:
+			conds.append('id IN (SELECT rowid FROM entrytext WHERE entrytext MATCH ?)')
+			args.append(' '.join('"%s"' % word.replace('"', '""') for word in words))
+		else:
+			for word in words:
+				conds.append('text LIKE ?')
+				args.append('%' + word + '%')
+		if pkgnm:
+			conds.append('pkgnm=?')
+			args.append(pkgnm)
+		if author:
+			conds.append('(authnm LIKE ? OR email LIKE ?)')
+			args.extend(('%' + author + '%',) * 2)
+		if vers:
+			conds.append("(vers=? OR substr(vers, 1, ?)=?)")
+			args.extend((vers, len(vers)+1, vers + '-'))
+		if urg:
+			conds.append('urg=?')
+			args.append(urg)
+		if since is not None:
+			conds.append('date>=?')
+			args.append(since)
+		if until is not None:
+			conds.append('date<?')
+			args.append(until)
+		sql = 'SELECT path, pos, pkgnm, vers, datestr, email, authnm, urg, text FROM entries'
+		if conds:
+			sql += ' WHERE ' + ' AND '.join(conds)
+		sql += ' ORDER BY date DESC, path, pos'
+		if limit:
+			sql += ' LIMIT %i' % limit
+		return conn.execute(sql, args).fetchall()
+
+class lazychangelog(changelog):
+	"""Changelog that only records the entry boundaries (byte offsets) on
+	   construction and parses entries when they are accessed.
+	   fd needs to be a seekable binary file object.
+	   Supports len(), indexing, slicing and iteration. Instances share
+	   fd and must not be used from several threads at once."""
+	def __init__(self, fd, fmt = 'rpm', joinln = False, tolerant = False, **kwds):
+		changelog.__init__(self, **kwds)
+		self.entries = self
+		self.fd = fd
+		self.fmt = fmt
+		self.joinln = joinln
+		self.tolerant = tolerant
+		self.cache = {}
+		self.scan()
+	@timed('split')
+	def scan(self):
+		"Find entry boundaries"
+		if ismappable(self.fd):
+			self.mapscan()
+		else:
+			self.linescan()
+	def mapscan(self):
+		"scan() with a regex search on the memory mapped file"
+		import mmap
+		if self.fmt == 'rpm':
+			rgx = RPMSEPRGX
+		else:
+			rgx = DEBHDRRGX
+		mm = mmap.mmap(self.fd.fileno(), 0, access = mmap.ACCESS_READ)
+		try:
+			self.offs = [0]
+			self.offs.extend(m.start() for m in rgx.finditer(mm, 1))
+			self.offs.append(len(mm))
+			self.lnos = [0]
+			for idx in range(1, len(self.offs)):
+				self.lnos.append(self.lnos[-1] + mm[self.offs[idx-1]:self.offs[idx]].count(b'\n'))
+		finally:
+			mm.close()
+	def linescan(self):
+		"scan() reading line by line"
+		self.offs = []
+		self.lnos = []
+		self.fd.seek(0)
+		rpmsep = RPMSEP.encode()
+		off = 0
+		lno = 0
+		isbuf = False
+		for ln in self.fd:
+			if self.fmt == 'rpm':
+				isnew = ln.rstrip(b'\r\n') == rpmsep
+			else:
+				isnew = ln[0:1] not in (b' ', b'\r', b'\n')
+			if isnew and isbuf:
+				self.offs.append(off)
+				self.lnos.append(lno)
+				isbuf = False
+			if not isbuf:
+				if not self.offs or self.offs[-1] != off:
+					self.offs.append(off)
+					self.lnos.append(lno)
+				isbuf = True
+			off += len(ln)
+			lno += 1
+		self.offs.append(off)
+		self.lnos.append(lno)
+		# Last offset only marks the end
+		if len(self.offs) > 1 and self.offs[-2] == off:
+			del self.offs[-2]
+			del self.lnos[-2]
+	def __len__(self):
+		return len(self.offs) - 1
+	def entry(self, idx):
+		"Return (parsed, cached) entry no idx, False if skipped (tolerant)"
+		try:
+			return self.cache[idx]
+		except KeyError:
+			pass
+		ent = self.cache[idx] = self.parsetext(idx, self.rawtext(idx))
+		return ent
+	def rawtext(self, idx):
+		"Original text of entry no idx"
+		self.fd.seek(self.offs[idx])
+		with stats.phase('read'):
+			return mapdecode(self.fd.read(self.offs[idx+1]-self.offs[idx]))
+	def stamp(self, idx):
+		"""stamp() of entry no idx, from the raw text (rawstamp()), it's
+		   only parsed if that fails"""
+		if idx not in self.cache:
+			stmp = rawstamp(self.rawtext(idx), self.fmt)
+			if stmp is not None:
+				return stmp
+		return self.entry(idx).stamp()
+	def rawitemtext(self, idx):
+		"text() of entry no idx, from the raw text (see rawitemtext())"
+		return rawitemtext(self.rawtext(idx), self.fmt)
+	def parsetext(self, idx, txt):
+		"Parse txt (from rawtext()) as entry no idx, uncached"
+		return self.parseentry(txt, self.fmt, self.joinln, self.tolerant,
+				       parsecontext(fdname(self.fd), self.lnos[idx]+1, self.diags))
+	def __getitem__(self, idx):
+		if isinstance(idx, slice):
+			return [ent for ent in (self.entry(i) for i in range(*idx.indices(len(self)))) if ent]
+		if idx < 0:
+			idx += len(self)
+		if idx < 0 or idx >= len(self):
+			raise IndexError('changelog entry index out of range')
+		return self.entry(idx)
+	def __iter__(self):
+		return self.iterfrom(0)
+	def cacheopts(self, outfmt, salt = ''):
+		"""Options string for entrycache keys: Everything besides the
+		   entry text that influences the output (salt e.g. for a version
+		   of the email -> name mappings)"""
+		kwds = sorted((urg, tuple(kwds)) for (urg, kwds) in textscan.kwds.items())
+		return repr((self.fmt, outfmt, self.joinln, self.tolerant, self.pkgnm,
+			     self.authover, self.distover, self.urgover, kwds, salt))
+	def cachedwrite(self, fd, outfmt, cache, salt = ''):
+		"""Write all entries in format outfmt to fd, only parsing and
+		   rendering those not found in entrycache cache (which gets the
+		   new ones). DEB headers are rebuilt after fixupdebver() on the
+		   entries' own (cached) versions and package names.
+		   Returns the number of entries (malformed ones, which are skipped
+		   with tolerant parsing, are neither cached nor counted). Entries
+		   salvaged with tolerant parsing are not cached either, so their
+		   problems get reported (diags) again on the next run."""
+		opts = self.cacheopts(outfmt, salt)
+		blocks = []
+		nent = 0
+		for idx in range(len(self)):
+			txt = self.rawtext(idx)
+			key = entrycache.key(opts, txt)
+			row = cache.get(key)
+			if row is None:
+				ndiags = len(self.diags)
+				ent = self.parsetext(idx, txt)
+				if not ent:
+					continue
+				if outfmt == 'rpm':
+					row = (ent.rpmout(), None, None, None, None)
+				else:
+					out = ent.debout()
+					row = (out[out.index('\n'):], ent.vers, ent.pkgnm, ent.dist, ent.urg)
+				if len(self.diags) == ndiags:
+					cache.put(key, *row)
+			nent += 1
+			if outfmt == 'rpm':
+				fd.write(row[0])
+			else:
+				blocks.append(row)
+		if outfmt == 'deb':
+			infos = [entryinfo(row[1], row[2]) for row in blocks]
+			self.fixupdebver(infos)
+			for (row, info) in zip(blocks, infos):
+				fd.write('%s (%s) %s; urgency=%s' % (info.pkgnm, info.vers, row[3], row[4]) + row[0])
+		return nent
+	def iterfrom(self, start = 0):
+		"Iterate over entries, starting at start (skipping malformed ones)"
+		for idx in range(start, len(self)):
+			ent = self.entry(idx)
+			if ent:
+				yield ent
+	def rpmout(self, start = 0, stop = None):
+		"output RPM changelog (entries start ... stop-1) as string"
+		return ''.join(ent.rpmout() for ent in self[start:stop])
+	def debout(self, start = 0, stop = None):
+		"""output DEB changelog (entries start ... stop-1) as string.
+		   Older entries only get parsed as far as needed to fill in
+		   missing versions."""
+		start, stop, step = slice(start, stop).indices(len(self))
+		out = []
+		ents = self.fixupdebveriter(self.iterfrom(start))
+		for idx in range(start, stop):
+			out.append(next(ents).debout())
+		return ''.join(out)
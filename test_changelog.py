@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+#
+# Regression tests for changelog.py
+#
+# (c) Kurt Garloff <kurt@garloff.de>, 1/2018
+# License: CC-BY-SA 3.0
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+import changelog
+
+RPMTEXT = """-------------------------------------------------------------------
+Wed May 29 17:43:38 UTC 2024 - alice@foo.org
+
+- Update to foo-3.0.0:
+  * fix a crash in the parser
+
+-------------------------------------------------------------------
+Sat May 11 13:27:03 UTC 2024 - bob@builder.net
+
+- Add patch for CVE-2019-1234
+
+-------------------------------------------------------------------
+Fri May  3 08:50:45 UTC 2024 - alice@foo.org
+
+- Update to foo-2.1.0:
+  * drop the deprecated api
+  * handle long options
+
+-------------------------------------------------------------------
+Mon Apr  1 10:00:00 UTC 2024 - bob@builder.net
+
+- Update to foo-2.0.0
+
+"""
+
+class crlftest(unittest.TestCase):
+	"Files with CRLF line ends parse like their LF counterparts"
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.debtext = self.parse(io.StringIO(RPMTEXT), 'rpm').debout()
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+	def tofile(self, txt):
+		fnm = os.path.join(self.dir, 'crlf')
+		with open(fnm, 'wb') as fd:
+			fd.write(txt.replace('\n', '\r\n').encode('utf-8'))
+		return fnm
+	@staticmethod
+	def parse(fd, fmt):
+		chglog = changelog.changelog(pkgnm = 'foo')
+		if fmt == 'rpm':
+			return chglog.rpmparse(fd)
+		else:
+			return chglog.debparse(fd)
+	def check(self, txt, fmt):
+		ref = self.parse(io.StringIO(txt), fmt)
+		nent = len(ref.entries)
+		with open(self.tofile(txt), 'rb') as fd:
+			mapped = changelog.changelog(pkgnm = 'foo')
+			mapped.entries = list(mapped.mapiter(fd, fmt))
+			self.assertEqual(len(mapped.entries), nent)
+			self.assertEqual(mapped.rpmout(), ref.rpmout())
+			lazy = changelog.lazychangelog(fd, fmt, pkgnm = 'foo')
+			self.assertEqual(len(lazy), nent)
+			self.assertEqual(lazy.rpmout(), ref.rpmout())
+		with open(self.tofile(txt), 'rb') as fd:
+			buf = io.BytesIO(fd.read())
+		lazy = changelog.lazychangelog(buf, fmt, pkgnm = 'foo')
+		self.assertEqual(len(lazy), nent)
+		self.assertEqual(lazy.rpmout(), ref.rpmout())
+	def test_rpm(self):
+		self.check(RPMTEXT, 'rpm')
+	def test_deb(self):
+		self.check(self.debtext, 'deb')
+
+class debhdrtest(unittest.TestCase):
+	"Malformed DEB headers are rejected or salvaged, never misparsed"
+	FOOTER = '\n\n  * fix a crash\n\n -- Bob <bob@builder.net>  Mon, 01 Apr 2024 10:00:00 +0000\n'
+	def parse(self, hdr, tolerant):
+		return changelog.logentry().debparse(hdr + self.FOOTER, False, tolerant)
+	def test_valid(self):
+		ent = self.parse('foo (1-2) unstable; urgency=medium', False)
+		self.assertEqual((ent.pkgnm, ent.vers, ent.dist, ent.urg), ('foo', '1-2', 'unstable', 'medium'))
+	def test_malformed(self):
+		for hdr in ('foo  (31.0.0-1) stable', 'foo (1-2) unstable urgency=low'):
+			self.assertRaises(changelog.ParseError, self.parse, hdr, False)
+		diags = []
+		ctx = changelog.parsecontext(None, 1, diags)
+		ent = changelog.logentry().debparse('foo  (31.0.0-1) stable' + self.FOOTER, False, True, ctx)
+		self.assertEqual((ent.pkgnm, ent.vers, ent.dist, ent.urg), ('foo', '31.0.0-1', 'stable', 'low'))
+		self.assertEqual(len(diags), 1)
+		ent = self.parse('foo (1-2) unstable urgency=low', True)
+		self.assertEqual((ent.pkgnm, ent.vers, ent.dist, ent.urg), ('foo', '1-2', 'unstable', 'low'))
+
+class untilvertest(unittest.TestCase):
+	"--until-version selects the same window from both formats"
+	@staticmethod
+	def window(txt, fmt, untilver):
+		chglog = changelog.changelog(pkgnm = 'foo')
+		filt = changelog.entryfilter(untilver = untilver)
+		if fmt == 'rpm':
+			chglog.rpmparse(io.StringIO(txt), filt = filt)
+		else:
+			chglog.debparse(io.StringIO(txt), filt = filt)
+		return [ent.stamp() for ent in chglog.entries]
+	def test_same_window(self):
+		debtext = crlftest.parse(io.StringIO(RPMTEXT), 'rpm').debout()
+		stamps = [ent.stamp() for ent in crlftest.parse(io.StringIO(RPMTEXT), 'rpm').entries]
+		for (untilver, nent) in (('3.0.0', 1), ('2.1.0', 3), ('2.0.0', 4), ('1.0', 4)):
+			rpmwin = self.window(RPMTEXT, 'rpm', untilver)
+			self.assertEqual(rpmwin, stamps[0:nent])
+			self.assertEqual(self.window(debtext, 'deb', untilver), rpmwin)
+
+if __name__ == '__main__':
+	unittest.main()